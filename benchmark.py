@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the Brandt Common Utilities
+"""
+import argparse, json, time, tempfile, resource, subprocess, re, random, shutil
+import multiprocessing, SocketServer
+
+# Import Brandt Common Utilities
+import sys, os
+sys.path.append( os.path.realpath( os.path.join( os.path.dirname(__file__), "/opt/brandt/common" ) ) )
+import brandt
+sys.path.pop()
+
+BASE = "dc=example,dc=com"
+OUS = 20
+
+def synthetic_entry(i, base = BASE):
+  """
+  Returns the i-th synthetic inetOrgPerson entry.
+  """
+  return ( "uid=user%07d,ou=people%02d,%s" % (i, i % OUS, base),
+           { 'objectClass': ['top', 'person', 'organizationalPerson', 'inetOrgPerson'],
+             'uid': ['user%07d' % i],
+             'cn': ['User %d' % i],
+             'sn': ['Surname%d' % i],
+             'givenName': ['Given%d' % (i % 500)],
+             'mail': ['user%07d@example.com' % i],
+             'telephoneNumber': ['+353 1 %07d' % i] } )
+
+def synthetic_entries(count, base = BASE):
+  """
+  Yields count inetOrgPerson entries spread over 20 organizational units.
+  """
+  for i in xrange(count):
+    yield synthetic_entry(i, base)
+
+def synthetic_ldif(count, directory = None):
+  """
+  Writes a synthetic LDIF file of count entries and returns its name.
+  """
+  fd, filename = tempfile.mkstemp(suffix = ".ldif", dir = directory)
+  f = os.fdopen(fd, "wb")
+  try:
+    brandt.writeLDIF(f, synthetic_entries(count))
+  finally:
+    f.close()
+  return filename
+
+
+# Minimal BER encoding for the stand-in directory server
+def _berLength(n):
+  if n < 0x80: return chr(n)
+  s = ""
+  while n:
+    s = chr(n & 0xff) + s
+    n >>= 8
+  return chr(0x80 | len(s)) + s
+
+def _ber(tag, payload):
+  return chr(tag) + _berLength(len(payload)) + payload
+
+def _berInt(tag, n):
+  s = ""
+  while True:
+    s = chr(n & 0xff) + s
+    n >>= 8
+    if not n: break
+  if ord(s[0]) & 0x80: s = "\x00" + s
+  return _ber(tag, s)
+
+def _berToInt(value):
+  n = int(value.encode("hex") or "0", 16)
+  if value and ord(value[0]) & 0x80: n -= 1 << (8 * len(value))
+  return n
+
+def _berDecode(data, pos = 0):
+  tag, length = ord(data[pos]), ord(data[pos + 1])
+  pos += 2
+  if length & 0x80:
+    n = length & 0x7f
+    length = _berToInt("\x00" + data[pos:pos + n])
+    pos += n
+  return tag, data[pos:pos + length], pos + length
+
+def _berSequence(data):
+  items, pos = [], 0
+  while pos < len(data):
+    tag, value, pos = _berDecode(data, pos)
+    items.append( (tag, value) )
+  return items
+
+PAGED_OID = "1.2.840.113556.1.4.319"
+
+class StandInDirectory(object):
+  """
+  Read only stand in for an LDAP server holding a synthetic
+  directory of count users below 20 organizational units. It answers
+  binds (any credentials), unbinds, abandons and searches, honours the
+  requested attributes and the simple paged results control, but does
+  not evaluate filters: every entry in scope is returned.
+  Entries are generated when they are sent, so memory does not grow with
+  the directory size.
+  """
+
+  def __init__(self, count, base = BASE):
+    self.count = int(count)
+    self.base = base
+
+  def __ou(self, n):
+    return ( "ou=people%02d,%s" % (n, self.base), {'objectClass': ['top', 'organizationalUnit'], 'ou': ['people%02d' % n]} )
+
+  def __root(self):
+    return ( self.base, {'objectClass': ['top', 'domain'], 'dc': [self.base.split(",")[0].split("=")[1]]} )
+
+  def scope(self, base, scope):
+    """
+    Returns (size, function) giving the entries in scope, or None when the
+    base DN does not exist.
+    """
+    base = brandt.formatDN(base)
+    root = brandt.formatDN(self.base)
+    if base == root:
+      if scope == 0: return 1, lambda k: self.__root()
+      if scope == 1: return OUS, self.__ou
+      return 1 + OUS + self.count, lambda k: k == 0 and self.__root() or k <= OUS and self.__ou(k - 1) or synthetic_entry(k - OUS - 1, self.base)
+    for n in range(OUS):
+      if base == brandt.formatDN(self.__ou(n)[0]):
+        users = max(0, (self.count - n + OUS - 1) // OUS)
+        if scope == 0: return 1, lambda k: self.__ou(n)
+        if scope == 1: return users, lambda k: synthetic_entry(n + OUS * k, self.base)
+        return 1 + users, lambda k: k == 0 and self.__ou(n) or synthetic_entry(n + OUS * (k - 1), self.base)
+    if base.startswith("uid=user"):
+      i = int(base[8:].split(",")[0])
+      if i < self.count and base == brandt.formatDN(synthetic_entry(i, self.base)[0]):
+        if scope == 0 or scope == 2: return 1, lambda k: synthetic_entry(i, self.base)
+        return 0, None
+    return None
+
+  def encode(self, msgid, entry, attributes):
+    dn, attrs = entry
+    payload = []
+    for attr in attrs:
+      if attributes is None or attr.lower() in attributes:
+        payload.append(_ber(0x30, _ber(0x04, attr) + _ber(0x31, "".join([ _ber(0x04, v) for v in attrs[attr] ]))))
+    return _ber(0x30, _berInt(0x02, msgid) + _ber(0x64, _ber(0x04, dn) + _ber(0x30, "".join(payload))))
+
+def _result(msgid, tag, code, controls = ""):
+  return _ber(0x30, _berInt(0x02, msgid) + _ber(tag, _berInt(0x0a, code) + _ber(0x04, "") + _ber(0x04, "")) + controls)
+
+class _StandInHandler(SocketServer.BaseRequestHandler):
+  def handle(self):
+    directory = self.server.directory
+    f = self.request.makefile("rb")
+    while True:
+      head = f.read(2)
+      if len(head) < 2: return
+      length = ord(head[1])
+      if length & 0x80: length = _berToInt("\x00" + f.read(length & 0x7f))
+      items = _berSequence(f.read(length))
+      msgid = _berToInt(items[0][1])
+      tag, op = items[1]
+      if tag == 0x60:
+        self.request.sendall(_result(msgid, 0x61, 0))
+      elif tag == 0x42:
+        return
+      elif tag == 0x63:
+        self.search(directory, msgid, op, [ v for t, v in items[2:] if t == 0xa0 ])
+      elif tag == 0x77:
+        self.request.sendall(_result(msgid, 0x78, 2))
+
+  def search(self, directory, msgid, op, controls):
+    fields = _berSequence(op)
+    scope = directory.scope(fields[0][1], _berToInt(fields[1][1]))
+    if scope is None:
+      self.request.sendall(_result(msgid, 0x65, 32))
+      return
+    attributes = [ v.lower() for t, v in _berSequence(fields[7][1]) ]
+    if not attributes or "*" in attributes: attributes = None
+
+    paged = None
+    for tag, value in (controls and _berSequence(controls[0]) or []):
+      control = _berSequence(value)
+      if control[0][1] == PAGED_OID: paged = _berSequence(_berDecode(control[-1][1])[1])
+    size, entry = scope
+    start, end = 0, size
+    if paged:
+      start = int(paged[1][1] or 0)
+      if _berToInt(paged[0][1]) > 0: end = min(size, start + _berToInt(paged[0][1]))
+
+    buf = []
+    for k in xrange(start, end):
+      buf.append(directory.encode(msgid, entry(k), attributes))
+      if len(buf) >= 256:
+        self.request.sendall("".join(buf))
+        buf = []
+    controls = ""
+    if paged:
+      cookie = end < size and str(end) or ""
+      controls = _ber(0xa0, _ber(0x30, _ber(0x04, PAGED_OID) + _ber(0x04, _ber(0x30, _berInt(0x02, size) + _ber(0x04, cookie)))))
+    buf.append(_result(msgid, 0x65, 0, controls))
+    self.request.sendall("".join(buf))
+
+class _StandInServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+def _serve(count, pipe):
+  server = _StandInServer(("127.0.0.1", 0), _StandInHandler)
+  server.directory = StandInDirectory(count)
+  pipe.send(server.server_address[1])
+  server.serve_forever()
+
+def start_directory(count):
+  """
+  Starts a StandInDirectory of count users in its own process, so it does
+  not share the GIL with the client being measured. Returns the process
+  and its ldap:// URL.
+  """
+  parent, child = multiprocessing.Pipe()
+  process = multiprocessing.Process(target = _serve, args = (count, child))
+  process.daemon = True
+  process.start()
+  return process, "ldap://127.0.0.1:%d" % parent.recv()
+
+
+# Scenarios, each run in a fresh process so the peak RSS is its own
+def _scenario_plain(url):
+  import ldapurl
+  source = ldapurl.LDAPUrl(url)
+  start = time.time()
+  l = brandt._MyLDAPObject("%s://%s" % (source.urlscheme, source.hostport))
+  l.simple_bind_s("", "")
+  results = l.search_ext_s(source.dn, source.scope, "(objectClass=*)", attrlist = source.attrs)
+  seconds = time.time() - start
+  l.unbind_s()
+  return {'entries': len(results), 'seconds': seconds, 'first_entry_seconds': seconds, 'pages': 1}
+
+def _scenario_paged(url, page_size):
+  search = brandt.LDAPSearch(pool = False)
+  start = time.time()
+  results = search.search(url, page_size = page_size)
+  seconds = time.time() - start
+  return {'entries': len(results), 'seconds': seconds, 'first_entry_seconds': seconds, 'pages': search.result_pages}
+
+def _scenario_streaming(source, page_size):
+  search = brandt.LDAPSearch(pool = False)
+  first, count = None, 0
+  start = time.time()
+  for entry in search.iter_search(source, page_size = page_size):
+    if first is None: first = time.time() - start
+    count += 1
+  return {'entries': count, 'seconds': time.time() - start, 'first_entry_seconds': first, 'pages': search.result_pages or 0}
+
+def _scenario_ldif(filename):
+  search = brandt.LDAPSearch()
+  start = time.time()
+  results = search.search(filename)
+  seconds = time.time() - start
+  return {'entries': len(results), 'seconds': seconds, 'first_entry_seconds': seconds, 'pages': 0}
+
+def _isolated(pipe, function, args):
+  try:
+    result = function(*args)
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  except Exception, e:
+    result = {'error': "%s: %s" % (type(e).__name__, e)}
+  pipe.send(result)
+
+def run_isolated(function, *args):
+  parent, child = multiprocessing.Pipe()
+  process = multiprocessing.Process(target = _isolated, args = (child, function, args))
+  process.start()
+  result = parent.recv()
+  process.join()
+  if 'entries' in result: result['entries_per_second'] = result['entries'] / max(result['seconds'], 1e-9)
+  return result
+
+def bench_search(args):
+  """
+  Times the plain, paged, streaming and LDIF file sources of LDAPSearch
+  against stand-in directories of each of --sizes entries.
+  """
+  output = {'page_size': args.page_size, 'runs': []}
+  for size in args.sizes:
+    process, server = start_directory(size)
+    url = "%s/%s??sub" % (server, BASE)
+    filename = synthetic_ldif(size, args.directory)
+    try:
+      for name, function, fargs in [ ('plain', _scenario_plain, (url,)),
+                                     ('paged', _scenario_paged, (url, args.page_size)),
+                                     ('streaming', _scenario_streaming, (url, args.page_size)),
+                                     ('ldif', _scenario_ldif, (filename,)),
+                                     ('ldif streaming', _scenario_streaming, (filename, args.page_size)) ]:
+        if name not in args.sources: continue
+        result = run_isolated(function, *fargs)
+        result.update({'source': name, 'size': size})
+        output['runs'].append(result)
+    finally:
+      os.remove(filename)
+      process.terminate()
+      process.join()
+  return output
+
+def bench_ldif(args):
+  """
+  Times readLDIF() and readLDIFParallel() with 1 to --workers processes.
+  """
+  filename = synthetic_ldif(args.entries, args.directory)
+  output = {'entries': args.entries, 'bytes': os.path.getsize(filename), 'cpus': multiprocessing.cpu_count(), 'runs': []}
+  try:
+    start = time.time()
+    count = sum( 1 for entry in brandt.readLDIF(open(filename, "rb")) )
+    output['runs'].append({'reader': 'readLDIF', 'workers': 1, 'seconds': time.time() - start, 'entries': count})
+
+    workers = 1
+    while workers <= args.workers:
+      start = time.time()
+      count = sum( 1 for entry in brandt.readLDIFParallel(filename, workers, args.chunk_size) )
+      output['runs'].append({'reader': 'readLDIFParallel', 'workers': workers, 'seconds': time.time() - start, 'entries': count})
+      workers *= 2
+  finally:
+    os.remove(filename)
+
+  for run in output['runs']:
+    run['entries_per_second'] = run['entries'] / max(run['seconds'], 1e-9)
+  return output
+
+def _legacyStrXML(string):
+  return ''.join([ s for s in str(string) if ord(s) in brandt.allowedASCII ])
+
+def _legacyFormatDN(dn):
+  dn = str(dn).strip().lower()
+  dn = re.sub("\s+,\s+",",",dn)
+  dn = re.sub("\s+=\s+","=",dn)
+  return dn
+
+def _legacyProper(string):
+  string=str(string).lower().replace("mysql","MySQL")
+  return string.title()
+
+def bench_strings(args):
+  """
+  Per value cost of the string helpers as they were (a per character
+  tuple scan, regexes looked up on every call) against the current ones
+  and their list variants, over the values and DNs of synthetic entries.
+  """
+  rng = random.Random(0)
+  entries = list(synthetic_entries(args.entries))
+  values = []
+  for dn, attrs in entries:
+    for attr in sorted(attrs):
+      values.extend( v + rng.choice(["", "\x01", "\x0b\x7f"]) for v in attrs[attr] )
+  dns = [ dn.replace(",", rng.choice([",", " , "])) for dn, attrs in entries ]
+  dns = [ dns[rng.randrange(len(dns))] for i in range(len(values)) ]
+
+  output = {'values': len(values), 'runs': []}
+  for name, data, functions in [ ('strXML', values, [ ('legacy', lambda l: [ _legacyStrXML(x) for x in l ]),
+                                                      ('current', lambda l: [ brandt.strXML(x) for x in l ]),
+                                                      ('many', brandt.strXMLMany) ]),
+                                 ('formatDN', dns, [ ('legacy', lambda l: [ _legacyFormatDN(x) for x in l ]),
+                                                     ('current', lambda l: [ brandt.formatDN(x) for x in l ]),
+                                                     ('many', brandt.formatDNMany) ]),
+                                 ('proper', values, [ ('legacy', lambda l: [ _legacyProper(x) for x in l ]),
+                                                      ('current', lambda l: [ brandt.proper(x) for x in l ]),
+                                                      ('many', brandt.properMany) ]) ]:
+    expected = None
+    for variant, function in functions:
+      best = None
+      for repeat in range(args.repeat):
+        start = time.time()
+        result = function(data)
+        best = min(best, time.time() - start) if best is not None else time.time() - start
+      if expected is None: expected = result
+      output['runs'].append({'function': name, 'variant': variant, 'seconds': best,
+                             'microseconds_per_value': best * 1e6 / len(data), 'same_output': result == expected})
+  return output
+
+_startupFiles = ["brandt.py", "brandtldap.py", "memoryleak.py"]
+_startupCommands = [ ('memoryleak.py --help', ['memoryleak.py', '--help']),
+                     ('import brandt', ['-c', 'import brandt']) ]
+
+def _exportRevision(revision, directory):
+  # Copies the files _startupCommands need, as of a git revision, into directory
+  here = os.path.dirname(os.path.realpath(__file__))
+  for name in _startupFiles:
+    if revision is None:
+      if os.path.isfile(os.path.join(here, name)): shutil.copy(os.path.join(here, name), directory)
+      continue
+    p = subprocess.Popen(['git', 'show', '%s:%s' % (revision, name)], cwd = here, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode == 0:
+      with open(os.path.join(directory, name), 'w') as f: f.write(out)
+
+def bench_startup(args):
+  """
+  Wall time of starting a fresh interpreter for each of _startupCommands,
+  for the working tree and each of --revisions, best and median of
+  --repeat runs. Also records whether import brandt loads python-ldap.
+  Byte code is written by a first untimed run, as it would be on a host.
+  """
+  output = {'python': sys.executable, 'runs': []}
+  devnull = open(os.devnull, 'w')
+  env = dict(os.environ)
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  for revision in [None] + args.revisions:
+    directory = tempfile.mkdtemp(dir = args.directory)
+    try:
+      _exportRevision(revision, directory)
+      p = subprocess.Popen([sys.executable, '-c', "import sys, brandt; sys.stdout.write(str('ldap' in sys.modules))"], cwd = directory, env = env, stdout = subprocess.PIPE, stderr = devnull)
+      imports_ldap = p.communicate()[0] == "True" if p.wait() == 0 else None
+      for name, command in _startupCommands:
+        times = []
+        subprocess.call([sys.executable] + command, cwd = directory, env = env, stdout = devnull, stderr = devnull)
+        for repeat in range(args.repeat):
+          start = time.time()
+          returncode = subprocess.call([sys.executable] + command, cwd = directory, env = env, stdout = devnull, stderr = devnull)
+          times.append(time.time() - start)
+        times.sort()
+        output['runs'].append({'revision': revision or 'working tree', 'command': name, 'returncode': returncode, 'imports_ldap': imports_ldap,
+                               'best_seconds': times[0], 'median_seconds': times[len(times) // 2]})
+    finally:
+      shutil.rmtree(directory)
+  devnull.close()
+  return output
+
+def git_commit():
+  try:
+    p = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.realpath(__file__)), stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    out, err = p.communicate()
+    return out.strip() or None
+  except OSError:
+    return None
+
+def command_line_args():
+  parser = argparse.ArgumentParser(description = "Benchmarks for the Brandt Common Utilities.")
+  parser.add_argument('-o', '--outputfile', default = "stdout", help = "File to write the JSON results to. (or stdout)")
+  parser.add_argument('-d', '--directory', default = None, help = "Directory for temporary files.")
+  subparsers = parser.add_subparsers(dest = 'benchmark')
+
+  search = subparsers.add_parser('search', help = "LDAPSearch against a local stand-in directory.")
+  search.add_argument('-s', '--sizes', type = lambda x: [ int(n) for n in x.split(",") ], default = [10000, 100000], help = "Comma separated directory sizes. (ie. 10000,100000,1000000)")
+  search.add_argument('-p', '--page-size', type = int, default = 1000, help = "Page size of the paged searches.")
+  search.add_argument('--sources', type = lambda x: x.split(","), default = ['plain', 'paged', 'streaming', 'ldif', 'ldif streaming'], help = "Comma separated sources to time.")
+  search.set_defaults(function = bench_search)
+
+  ldif = subparsers.add_parser('ldif', help = "LDIF parsing, serial and with a process pool.")
+  ldif.add_argument('-e', '--entries', type = int, default = 200000, help = "Number of entries in the LDIF file.")
+  ldif.add_argument('-w', '--workers', type = int, default = multiprocessing.cpu_count(), help = "Highest number of worker processes.")
+  ldif.add_argument('-c', '--chunk-size', type = int, default = 8388608, help = "Chunk size in bytes.")
+  ldif.set_defaults(function = bench_ldif)
+
+  strings = subparsers.add_parser('strings', help = "strXML, formatDN and proper, per value and in bulk.")
+  strings.add_argument('-e', '--entries', type = int, default = 20000, help = "Number of entries the values are taken from.")
+  strings.add_argument('-r', '--repeat', type = int, default = 3, help = "Best of this many runs.")
+  strings.set_defaults(function = bench_strings)
+
+  startup = subparsers.add_parser('startup', help = "Interpreter startup of memoryleak.py --help and import brandt.")
+  startup.add_argument('-r', '--revisions', type = lambda x: x.split(","), default = [], help = "Comma separated git revisions to compare with the working tree. (ie. HEAD~1)")
+  startup.add_argument('-n', '--repeat', type = int, default = 20, help = "Number of runs per command.")
+  startup.set_defaults(function = bench_startup)
+  return parser.parse_args()
+
+# Start program
+if __name__ == "__main__":
+  args = command_line_args()
+  results = args.function(args)
+  results['benchmark'] = args.benchmark
+  results['commit'] = git_commit()
+  results['date'] = str(time.strftime("%Y-%m-%d %H:%M:%S"))
+  if str(args.outputfile).lower() == "stdout":
+    print json.dumps(results, indent = 2, sort_keys = True)
+  else:
+    f = open(args.outputfile, 'w')
+    f.write(json.dumps(results, indent = 2, sort_keys = True) + "\n")
+    f.close()
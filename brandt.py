@@ -2,17 +2,23 @@
 """
 Common Python code used between different projects
 """
-import fcntl, termios, struct, os, re, sys
+import struct, os, re, sys, collections, types
+import cStringIO, mmap, marshal, binascii, itertools
 import syslog as SYSLOG
 
-import ldapurl, ldap
-from ldap.ldapobject import LDAPObject
-from ldap.controls import SimplePagedResultsControl
+# The LDAP support (brandtldap, which needs python-ldap) and the persistent
+# syslog classes (brandtsyslog) are only imported the first time one of
+# their names is looked up on this module.
+_lazyNames = dict( [ (name, "brandtldap") for name in ( "LDAPSearch", "LDAPResults", "LDAPResultsDict", "LDAPIndex",
+                                                        "LDAPResultCache", "LDAPConnectionPool", "ldapPool", "LDAPStats",
+                                                        "StatsDSink", "PrometheusSink", "_PagedResultsSearchObject", "_MyLDAPObject" ) ] +
+                   [ (name, "brandtsyslog") for name in ( "SysLog", "SysLogHandler" ) ] )
 
 def getTerminalSize():
   """
   Returns a tuple containing (rows,columns)
   """
+  import fcntl, termios
   def ioctl_GWINSZ(fd):
     try:    
       cr = struct.unpack('hh', fcntl.ioctl(fd, termios.TIOCGWINSZ, '1234'))
@@ -40,28 +46,124 @@ def sortDictbyField(d, field):
   return sorted(d.keys(), key=lambda x: d[x][field])
 
 
-def printTable(items, columns, separator="\t"):
+def printTable(items, columns, separator="\t", output=None):
   """
   Print a list of values in neat columns
   """  
-  tmp = []
-  widths=[]
-  output = ""
-
-  for i in range(0,len(items),columns):
-    tmp.append([])
-    for j in range(columns):
-      if i + j < len(items): 
-        tmp[-1].append(str(items[i + j]))
-      else:
-        tmp[-1].append('')
-
-  for i in range(columns): widths.append(max([len(x[i]) for x in tmp]))
-
-  for i in range(len(tmp)):
-    for j in range(columns):
-      tmp[i][j] = tmp[i][j].ljust(widths[j])
-    output += separator.join(tmp[i]) + '\n'
+  rows = ( list(items[i:i + columns]) + [''] * (i + columns - len(items)) for i in xrange(0, len(items), columns) )
+  return renderTable(rows, output, separator = separator, sample = None)
+
+def _tableCells(row, columns):
+  if isinstance(row, dict): row = [ row.get(column, '') for column in columns ]
+  cells = []
+  for value in row:
+    if isinstance(value, (list, tuple)): value = ", ".join([ str(v) for v in value ])
+    cells.append(str(value))
+  return cells
+
+def _tableFit(widths, width, separator):
+  # Caps the widest columns so a line fits in width characters
+  available = width - len(separator) * (len(widths) - 1)
+  if available < len(widths) or sum(widths) <= available: return widths
+  low, high = 1, max(widths)
+  while low < high:
+    cap = (low + high + 1) // 2
+    if sum([ min(w, cap) for w in widths ]) <= available: low = cap
+    else: high = cap - 1
+  return [ min(w, low) for w in widths ]
+
+def renderTable(rows, output = None, columns = None, headers = None, separator = "  ", sample = 1000, spill = False, width = None, wrap = False):
+  """
+  Writes rows to the file object output (default sys.stdout) in aligned
+  columns, a row at a time. A row is a sequence of values, or a dictionary
+  read through columns; lists and tuples are joined with ", ". Rows may be
+  any iterable (a generator over LDAPSearch results, or
+  ( d[k] for k in sortDictbyField(d, field) ) ), they are not copied.
+
+  The column widths come from headers and the first sample rows (None for
+  all of them), later rows wider than that simply overflow. With
+  spill = True they come from every row instead, the rows being spilled
+  to a temporary file while they are measured.
+
+  width limits the line length (the terminal width when output is a
+  terminal), cells that do not fit are cut, or with wrap = True continued
+  on the following lines. Returns the number of rows written.
+  """
+  if output is None: output = sys.stdout
+  if headers is None and columns is not None: headers = columns
+  if width is None and hasattr(output, "isatty") and output.isatty(): width = getTerminalSize()[0]
+  rows = iter(rows)
+
+  widths = [ len(str(h)) for h in headers ] if headers else []
+  def measure(cells):
+    if len(cells) > len(widths): widths.extend([0] * (len(cells) - len(widths)))
+    for i, cell in enumerate(cells):
+      if len(cell) > widths[i]: widths[i] = len(cell)
+
+  if spill:
+    import tempfile
+    buffered = tempfile.TemporaryFile()
+    for row in rows:
+      cells = _tableCells(row, columns)
+      measure(cells)
+      marshal.dump(cells, buffered)
+    buffered.seek(0)
+    def replay():
+      while True:
+        try:
+          yield marshal.load(buffered)
+        except EOFError:
+          return
+    head, rest = replay(), iter(())
+  else:
+    head = [ _tableCells(row, columns) for row in (rows if sample is None else itertools.islice(rows, sample)) ]
+    for cells in head: measure(cells)
+    rest = ( _tableCells(row, columns) for row in rows )
+  if width: widths = _tableFit(widths, width, separator)
+  last = len(widths) - 1
+
+  def line(cells):
+    out = []
+    for i, cell in enumerate(cells):
+      if i >= last: out.append(cell)
+      else: out.append(cell.ljust(widths[i]))
+    return separator.join(out).rstrip() + "\n"
+
+  def write(cells):
+    if not width:
+      output.write(line(cells))
+      return
+    cut = [ cell[:widths[i]] if i < len(widths) else cell for i, cell in enumerate(cells) ]
+    output.write(line(cut))
+    while wrap:
+      cells = [ cell[widths[i]:] if i < len(widths) else '' for i, cell in enumerate(cells) ]
+      if not any(cells): break
+      output.write(line([ cell[:widths[i]] if i < len(widths) else cell for i, cell in enumerate(cells) ]))
+
+  count = 0
+  try:
+    if headers:
+      write([ str(h) for h in headers ])
+      write([ "-" * w for w in widths[:len(headers)] ])
+    for cells in itertools.chain(head, rest):
+      write(cells)
+      count += 1
+  finally:
+    if spill: buffered.close()
+  return count
+
+def ldapRows(entries, attributes, dn = True):
+  """
+  Yields a row per (dn, attributes) entry (LDAPSearch results, LDAPResults
+  or iter_search()), holding the DN and the values of attributes, for
+  renderTable(). Search references (a None DN with a List of referral
+  URLs) are skipped.
+  """
+  for entry_dn, attrs in entries:
+    if entry_dn is None or not isinstance(attrs, dict): continue
+    row = [ attrs.get(attribute, []) for attribute in attributes ]
+    if dn: row.insert(0, entry_dn)
+    yield row
 
 
 def proper(string):
@@ -71,263 +173,234 @@ def proper(string):
   string=str(string).lower().replace("mysql","MySQL")
   return string.title()
 
+def properMany(strings):
+  """
+  proper() over a list of strings, returning a list.
+  """
+  return [ str(string).lower().replace("mysql","MySQL").title() for string in strings ]
+
 allowedASCII = tuple([9,10,13] + range(32,127))
+_xmlDelete = (None, None)
+def _xmlDeleteChars():
+  # The characters str.translate() must strip, rebuilt if allowedASCII is replaced
+  global _xmlDelete
+  if _xmlDelete[0] is not allowedASCII:
+    allowed = set(allowedASCII)
+    _xmlDelete = (allowedASCII, "".join([ chr(c) for c in range(256) if c not in allowed ]))
+  return _xmlDelete[1]
+
 def strXML(string):
   """
   Converts strings to an XML safe string. Basically ripping out every 
   character that is not known to be compatible.
   """    
-  global allowedASCII
-  return ''.join([ s for s in str(string) if ord(s) in allowedASCII ])
+  return str(string).translate(None, _xmlDeleteChars())
+
+def strXMLMany(strings):
+  """
+  strXML() over a list of strings, returning a list.
+  """
+  delete = _xmlDeleteChars()
+  return [ str(string).translate(None, delete) for string in strings ]
 
+_dnComma = re.compile(r"\s+,\s+")
+_dnEquals = re.compile(r"\s+=\s+")
+_dnCache = {}
 def formatDN(dn):
-  dn = str(dn).strip().lower()
-  dn = re.sub("\s+,\s+",",",dn)
-  dn = re.sub("\s+=\s+",",",dn)
-  return dn
-
-# https://bitbucket.org/jaraco/python-ldap/src/f208b6338a28/Demo/paged_search_ext_s.py
-class _PagedResultsSearchObject():
-  def paged_search_ext_s(self,base,scope,filterstr='(objectClass=*)',attrlist=None,attrsonly=0,serverctrls=None,clientctrls=None,timeout=-1,sizelimit=0,criticality=True,page_size=1000):
-    """
-    Behaves exactly like LDAPObject.search_ext_s() but internally uses the
-    simple paged results control to retrieve search results in chunks.
-    This is non-sense for really large results sets which you would like
-    to process one-by-one
-    """
-
-    req_ctrl = SimplePagedResultsControl(criticality,size=page_size,cookie='')
-
-    # Send first search request
-    msgid = self.search_ext(
-      base,
-      scope,
-      filterstr,
-      attrlist=attrlist,
-      serverctrls=(serverctrls or [])+[req_ctrl]
-    )
-
-    result_pages = 0
-    all_results = []
-    
-    while True:
-      rtype, rdata, rmsgid, rctrls = self.result3(msgid)
-      all_results.extend(rdata)
-      result_pages += 1
-      # Extract the simple paged results response control
-      pctrls = [
-        c
-        for c in rctrls
-        if c.controlType == SimplePagedResultsControl.controlType
-      ]
-      if pctrls:
-        if pctrls[0].cookie:
-            # Copy cookie from response control to request control
-            req_ctrl.cookie = pctrls[0].cookie
-            msgid = self.search_ext(
-              base,
-              scope,
-              filterstr,
-              attrlist=attrlist,
-              serverctrls=(serverctrls or [])+[req_ctrl]
-            )
+  """
+  Returns dn lower cased, with the spaces around its separators removed.
+  Results are memoised, DNs repeat a lot across entries.
+  """
+  dn = str(dn)
+  try:
+    return _dnCache[dn]
+  except KeyError:
+    pass
+  formatted = _dnEquals.sub("=", _dnComma.sub(",", dn.strip().lower()))
+  if len(_dnCache) >= 65536: _dnCache.clear()
+  _dnCache[dn] = formatted
+  return formatted
+
+def formatDNMany(dns):
+  """
+  formatDN() over a list of DNs, returning a list.
+  """
+  return [ formatDN(dn) for dn in dns ]
+
+def readLDIF(source, mmapped = False):
+  """
+  Generator yielding the (dn, {attr: [values]}) entries of an LDIF file
+  object (or stream) one at a time, so memory is bounded by the largest
+  entry. With mmapped the file is memory mapped when it can be (regular
+  files only, streams are read normally).
+  """
+  lines, m = source, None
+  if mmapped:
+    try:
+      m = mmap.mmap(source.fileno(), 0, access = mmap.ACCESS_READ)
+      m.seek(source.tell())
+      lines = iter(m.readline, "")
+    except (AttributeError, EnvironmentError, ValueError):
+      pass
+
+  dn, attrs, logical = None, {}, None
+  try:
+    for line in itertools.chain(lines, [""]):
+      line = line.rstrip("\n")
+      if line[-1:] == "\r": line = line[:-1]
+      if line[:1] == " ":
+        if logical is not None: logical.append(line[1:])
+        continue
+
+      if logical:
+        attr, sep, value = "".join(logical).partition(":")
+        logical = None
+        if value[:1] == ":":
+          value = binascii.a2b_base64(value[1:])
+        elif value[:1] == "<":
+          url = value[1:].strip()
+          if not url.startswith("file://"): raise ValueError, "Unsupported URL in LDIF: " + url
+          f = open(url[7:], "rb")
+          try:
+            value = f.read()
+          finally:
+            f.close()
         else:
-            break
-    return result_pages,all_results
-
-class _MyLDAPObject(LDAPObject,_PagedResultsSearchObject):
-  pass
-
-class LDAPSearch(object):
-  """ 
-  The class returns a List of a Truples of a String and a Dicionary of a List
-      
-    ldapurl     = ldap[s]://[host[:port]][/base[?[attributes][?[scope][?[filter][?extensions]]]]]
-    scope       = "base" / "one" / "sub"
-    ldap://ldap.opw.ie:389/o=opw?cn,mail?base
-    ldaps://ldap1.opw.ie/ou=userapp,o=opw?cn,mail?sub??bindname=cn=brandtb%2cou=it%2co=opw,X-BINDPW=password
+          value = value.lstrip(" ")
+        if attr.lower() == "dn":
+          dn = value
+        elif dn is not None:
+          attrs.setdefault(attr, []).append(value)
+
+      if not line:
+        if dn is not None: yield (dn, attrs)
+        dn, attrs = None, {}
+      elif line[0] != "#":
+        logical = [line]
+  finally:
+    if m is not None: m.close()
+
+def _readLDIFChunk(chunk):
+  filename, start, end = chunk
+  f = open(filename, "rb")
+  try:
+    f.seek(start)
+    # marshal is several times cheaper than the pickling done by the pool
+    return marshal.dumps(list(readLDIF(cStringIO.StringIO(f.read(end - start)))))
+  finally:
+    f.close()
+
+def splitLDIF(filename, chunk_size = 8388608):
   """
-  
-  def __init__(self, source = None, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None):
-    self.__source = None
-    self.__type = None
-    self.__sourcename = None
-    self.__result_pages = None
-    self.__results = None 
-    self.__resultsDict = None
-    self.__ldap_version = 3
-    self.__trace_level = 0
-    self.__debug_level = 0
-    self.__referrals = False
-    self.__page_size = 1000
-
-    if source != None: self.search(source, ldap_version, trace_level, debug_level, referrals, page_size)
- 
-  def getSource(self):
-    return self.__source
-
-  def setSource(self, source):
-    if str(type(source)) == "<type 'str'>" and source == "stdin":
-      self.__source = sys.stdin
-      self.__type = "stream"
-      self.__sourcename = "stdin"            
-    elif str(type(source)) == "<type 'file'>":
-      self.__source = source
-      self.__type = "file"
-      self.__sourcename = str(source.name).lstrip("<").rstrip(">")
-    elif str(type(source)) == "<type 'str'>":
-      try:
-        self.__source = ldapurl.LDAPUrl(source)
-        self.__type = "url"
-        self.__sourcename = source
-      except:
-        try:
-          self.__source = open(source)
-          self.__type = "file"
-          self.__sourcename = str(source)
-        except:
-          self.__source = None
-          self.__type = None
-          self.__sourcename = None
-          raise ValueError, "Parameter source does not seem to be a LDAP URL or File."
-
-    else:
-      self.__source = None
-      self.__type = None
-      self.__sourcename = None
-      raise ValueError, "Parameter source does not seem to be a LDAP URL or File."
-
-  source = property(getSource, setSource)
-
-  def getType(self):
-    if self.__type != None:
-      return self.__type
-    else:
-      raise ValueError, "Source does not seem to be a LDAP URL or File."
-      return None
-  type=property(getType)
-
-  def getSourceName(self):
-    if self.__sourcename != None:
-      return self.__sourcename
-    else:
-      raise ValueError, "Source does not seem to be a LDAP URL or File."
-      return None
-  sourcename=property(getSourceName)        
-
-  def getresults(self):
-    return self.__results
-  results = property(getresults)
-  result_pages = property(lambda self: self.__result_pages)
-
-  def __doNothing(*x): return x[-1]
-
-  def resultsDict(self, functDN = __doNothing, functAttr = __doNothing, functValue = __doNothing):
-    if self.__results and not self.__resultsDict:
-      self.__resultsDict = {}
-      for entry in self.__results:
-        if entry and len(entry) == 2 and entry[0]:
-          dn = functDN(entry[0])
-          self.__resultsDict[dn] = {}
-          for attr in sorted(entry[1].keys()):
-            value = sorted([ functValue(functAttr(attr), v) for v in entry[1][attr] ])
-            self.__resultsDict[dn].update( { functAttr(attr): value } )
-    return self.__resultsDict
-
-  def search(self, source, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None):
-    timeout = 0
-    self.source = source
-    self.__results = []
-    if self.type == "file" or self.type == "stream":
-      ldifFile = ldif.LDIFRecordList(self.__source)
-      ldifFile.parse()
-      self.__results = ldifFile.all_records
-
-    elif self.type == "url":
-      filterstr = self.source.filterstr
-      if filterstr == None: filterstr = "(objectClass=*)"
-      con_string = "%s://%s" % (self.source.urlscheme, self.source.hostport)    
-      extensions = self.source.extensions
-      
-      if ldap_version != None: self.__ldap_version = int(ldap_version)
-      if trace_level != None:  self.__trace_level = int(trace_level)
-      if debug_level != None:  self.__debug_level = int(debug_level)
-      if referrals != None:    self.__referrals = bool(referrals)
-      if page_size != None:    self.__page_size = int(page_size)
-      ldap.set_option(ldap.OPT_DEBUG_LEVEL,self.__debug_level)
-      ldap.set_option(ldap.OPT_REFERRALS, int(self.__referrals))
-
-      l = _MyLDAPObject(con_string,trace_level=self.__trace_level)
-      l.protocol_version = self.__ldap_version
-      #l.start_tls_s()
-      if self.source.who:
-        l.simple_bind_s(self.source.who, self.source.cred)
+  Returns a List of (start, end) offsets splitting an LDIF file into
+  chunks of about chunk_size bytes, cut only on blank lines (found by
+  scanning a memory map of the file) so no entry spans two chunks.
+  """
+  chunks = []
+  f = open(filename, "rb")
+  try:
+    size = os.fstat(f.fileno()).st_size
+    if not size: return chunks
+    m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+      start = 0
+      while start < size:
+        end = start + chunk_size
+        if end < size:
+          found = [ x for x in (m.find("\n\n", end), m.find("\n\r\n", end)) if x >= 0 ]
+          end = found and min(found) + 1 or size
+        chunks.append( (start, min(end, size)) )
+        start = end
+    finally:
+      m.close()
+  finally:
+    f.close()
+  return chunks
+
+def readLDIFParallel(filename, workers = None, chunk_size = 8388608):
+  """
+  Same as readLDIF() for an LDIF file name, but the chunks of splitLDIF()
+  are parsed by a pool of workers processes (one per CPU by default).
+  Entries are yielded in file order and at most two chunks per worker are
+  held in memory.
+  """
+  import multiprocessing
+  workers = int(workers or multiprocessing.cpu_count())
+  pool = multiprocessing.Pool(workers)
+  try:
+    pending = collections.deque()
+    for start, end in splitLDIF(filename, chunk_size):
+      pending.append(pool.apply_async(_readLDIFChunk, ((filename, start, end),)))
+      if len(pending) > workers * 2:
+        for entry in marshal.loads(pending.popleft().get()): yield entry
+    while pending:
+      for entry in marshal.loads(pending.popleft().get()): yield entry
+  finally:
+    pool.terminate()
+    pool.join()
+
+_ldifSafe = re.compile(r"^[\x01-\x09\x0b\x0c\x0e-\x1f\x21-\x39\x3b\x3d-\x7f][\x01-\x09\x0b\x0c\x0e-\x7f]*(?<! )\Z")
+def writeLDIF(output, entries, cols = 76, buffer_size = 65536):
+  """
+  Writes entries as LDIF to the file object output, buffering the text
+  into writes of about buffer_size bytes. Values which are not safe LDIF
+  strings are base64 encoded and lines are folded at cols characters.
+  Returns the number of entries written.
+  """
+  buf, size, count = [], 0, 0
+  for dn, attrs in entries:
+    if not dn or not isinstance(attrs, dict): continue
+    lines = [("dn", dn)]
+    for attr in attrs:
+      for value in attrs[attr]: lines.append((attr, value))
+    for attr, value in lines:
+      value = str(value)
+      if not value or _ldifSafe.match(value):
+        line = "%s: %s" % (attr, value)
       else:
-        l.simple_bind_s('', '') # anonymous bind
-
-      # Send search request
-      try:
-        self.__result_pages, self.__results = l.paged_search_ext_s(
-          self.source.dn,
-          self.source.scope,
-          filterstr,
-          attrlist=self.source.attrs,
-          serverctrls=None,
-          page_size=self.__page_size
-        )
-      except ldap.UNAVAILABLE_CRITICAL_EXTENSION:
-        self.__result_pages = 0
-        self.__results = l.search_ext_s(
-          self.source.dn,
-          self.source.scope,
-          filterstr,
-          attrlist=self.source.attrs,
-          serverctrls=None
-        )
-      except: 
-        exc_type, exc_value, exc_traceback = sys.exc_info()        
-        raise exc_type, exc_value
-
-      l.unbind_s()
-      return self.__results
-
-  def attributelist(self, attribute):
-    temp = {}
-    for entry in self.results:            
-      for attr in entry[1]:
-        if attr == attribute:
-          for value in entry[1][attr]:
-            temp[value] = value            
-    return tuple( temp.keys() )
-  
-  def __str__(self):
-    tmp = ""
-    if self.results:
-      for result in self.results:
-        tmp += str(result) + "\n"
-    return tmp.strip("\n")
-    
+        line = "%s:: %s" % (attr, binascii.b2a_base64(value).rstrip("\n"))
+      if len(line) > cols:
+        folded = [line[:cols]]
+        for n in xrange(cols, len(line), cols - 1): folded.append(" " + line[n:n + cols - 1])
+        line = "\n".join(folded)
+      buf.append(line)
+      size += len(line) + 1
+    buf.append("")
+    count += 1
+    if size >= buffer_size:
+      buf.append("")
+      output.write("\n".join(buf))
+      buf, size = [], 0
+  if buf:
+    buf.append("")
+    output.write("\n".join(buf))
+  return count
+
+syslogPriorities = { "emerg":SYSLOG.LOG_EMERG, "alert":SYSLOG.LOG_ALERT, 
+                     "crit":SYSLOG.LOG_CRIT, "err":SYSLOG.LOG_ERR, 
+                     "warning":SYSLOG.LOG_WARNING, "notice":SYSLOG.LOG_NOTICE, 
+                     "info":SYSLOG.LOG_INFO, "debug":SYSLOG.LOG_DEBUG }
+syslogFacilities = { "kern":SYSLOG.LOG_KERN, "user":SYSLOG.LOG_USER, 
+                     "mail":SYSLOG.LOG_MAIL, "daemon":SYSLOG.LOG_DAEMON, 
+                     "auth":SYSLOG.LOG_AUTH, "lpr":SYSLOG.LOG_LPR, 
+                     "news":SYSLOG.LOG_NEWS, "uucp":SYSLOG.LOG_UUCP, 
+                     "cron":SYSLOG.LOG_CRON, "syslog":SYSLOG.LOG_SYSLOG, 
+                     "local0":SYSLOG.LOG_LOCAL0, "local1":SYSLOG.LOG_LOCAL1, 
+                     "local2":SYSLOG.LOG_LOCAL2, "local3":SYSLOG.LOG_LOCAL3, 
+                     "local4":SYSLOG.LOG_LOCAL4, "local5":SYSLOG.LOG_LOCAL5, 
+                     "local6":SYSLOG.LOG_LOCAL6, "local7":SYSLOG.LOG_LOCAL7 }
+syslogOptions = { "pid":SYSLOG.LOG_PID, "cons":SYSLOG.LOG_CONS, "ndelay":SYSLOG.LOG_NDELAY, 
+                  "nowait":SYSLOG.LOG_NOWAIT, "perror":SYSLOG.LOG_PERROR }
+
 def syslog(message, ident = "", priority = "info", facility = "syslog", options = []):
   """
   Send a string to syslog and return that same string.
   """
-  priority = { "emerg":SYSLOG.LOG_EMERG, "alert":SYSLOG.LOG_ALERT, 
-               "crit":SYSLOG.LOG_CRIT, "err":SYSLOG.LOG_ERR, 
-               "warning":SYSLOG.LOG_WARNING, "notice":SYSLOG.LOG_NOTICE, 
-               "info":SYSLOG.LOG_INFO, "debug":SYSLOG.LOG_DEBUG }.get(str(priority).lower(),0)
-  facility = { "kern":SYSLOG.LOG_KERN, "user":SYSLOG.LOG_USER, 
-               "mail":SYSLOG.LOG_MAIL, "daemon":SYSLOG.LOG_DAEMON, 
-               "auth":SYSLOG.LOG_AUTH, "lpr":SYSLOG.LOG_LPR, 
-               "news":SYSLOG.LOG_NEWS, "uucp":SYSLOG.LOG_UUCP, 
-               "cron":SYSLOG.LOG_CRON, "syslog":SYSLOG.LOG_SYSLOG, 
-               "local0":SYSLOG.LOG_LOCAL0, "local1":SYSLOG.LOG_LOCAL1, 
-               "local2":SYSLOG.LOG_LOCAL2, "local3":SYSLOG.LOG_LOCAL3, 
-               "local4":SYSLOG.LOG_LOCAL4, "local5":SYSLOG.LOG_LOCAL5, 
-               "local6":SYSLOG.LOG_LOCAL6, "local7":SYSLOG.LOG_LOCAL7 }.get(str(facility).lower(),0)
+  priority = syslogPriorities.get(str(priority).lower(),0)
+  facility = syslogFacilities.get(str(facility).lower(),0)
   option = 0
   for opt in options:
-    option += { "pid":SYSLOG.LOG_PID, "cons":SYSLOG.LOG_CONS, "ndelay":SYSLOG.LOG_NDELAY, 
-                "nowait":SYSLOG.LOG_NOWAIT, "perror":SYSLOG.LOG_PERROR }.get(str(opt).lower(),0)
+    option += syslogOptions.get(str(opt).lower(),0)
   message = str(message)
   ident = str(ident)
   if not ident: ident = os.path.basename(sys.argv[0])
@@ -340,7 +413,6 @@ def syslog(message, ident = "", priority = "info", facility = "syslog", options
   SYSLOG.closelog()
   return message
 
-
 # class find(object):
 
 #   BlockFile = property( lambda self: 'b' )
@@ -395,8 +467,34 @@ def syslog(message, ident = "", priority = "info", facility = "syslog", options
 
 
 
+class _LazyModule(types.ModuleType):
+  """
+  What "import brandt" returns: this module, which imports the module
+  holding one of the _lazyNames the first time that name is looked up, so
+  scripts which never use LDAP neither pay for nor need python-ldap.
+  """
+
+  def __init__(self, module):
+    types.ModuleType.__init__(self, module.__name__, module.__doc__)
+    self.__dict__.update(module.__dict__)
+    # The functions above keep using the original module's globals
+    self.__dict__['_module'] = module
+
+  def __setattr__(self, name, value):
+    types.ModuleType.__setattr__(self, name, value)
+    setattr(self._module, name, value)
+
+  def __getattr__(self, name):
+    if name not in _lazyNames: raise AttributeError, "'module' object has no attribute '%s'" % name
+    value = getattr(__import__(_lazyNames[name]), name)
+    setattr(self, name, value)
+    return value
+
+if __name__ != "__main__": sys.modules[__name__] = _LazyModule(sys.modules[__name__])
+
 # Start program
 if __name__ == "__main__":
+  from brandtldap import LDAPSearch
   url = "ldaps://opwdc2:636/dc=i,dc=opw,dc=ie?cn,mail?sub"
   #url = "ldaps://nds2:636/o=opw?cn,mail?sub"
   url = "ldap://dublinnotes:389/?cn,mail?sub"
@@ -0,0 +1,1600 @@
+#!/usr/bin/env python
+"""
+LDAP support of the Brandt Common Utilities. brandt imports it on first
+use of LDAPSearch (or any other of its LDAP names), use it through brandt.
+"""
+import os, re, sys, time, errno, threading, atexit, copy, collections, hashlib, hmac
+import Queue, cPickle, select, socket, itertools
+
+import ldapurl, ldap, ldap.filter
+from ldap.ldapobject import LDAPObject
+from ldap.controls import SimplePagedResultsControl
+
+from brandt import formatDN, readLDIF, readLDIFParallel, writeLDIF, renderTable, ldapRows
+
+# https://bitbucket.org/jaraco/python-ldap/src/f208b6338a28/Demo/paged_search_ext_s.py
+class _PagedResultsSearchObject():
+  def paged_search_iter(self,base,scope,filterstr='(objectClass=*)',attrlist=None,attrsonly=0,serverctrls=None,clientctrls=None,timeout=-1,sizelimit=0,criticality=True,page_size=1000,prefetch=False,max_page_size=None,stats=None):
+    """
+    Generator version of paged_search_ext_s(). Yields the list of entries
+    of each page as soon as result3() returns it, so only one page is held
+    in memory at a time.
+
+    With prefetch the request for the next page is sent before the current
+    page is yielded, so the server works on it while the caller processes
+    the current one. With max_page_size the page size is doubled (up to
+    max_page_size) for as long as the time per entry spent waiting in
+    result3() keeps dropping, so the time the caller takes does not count.
+    The wait for each page is recorded in stats (an LDAPStats) if given.
+    """
+
+    req_ctrl = SimplePagedResultsControl(criticality,size=page_size,cookie='')
+    best_latency = None
+
+    # Send first search request
+    msgid = self.search_ext(
+      base,
+      scope,
+      filterstr,
+      attrlist=attrlist,
+      serverctrls=(serverctrls or [])+[req_ctrl]
+    )
+
+    try:
+      while msgid is not None:
+        started = time.time()
+        rtype, rdata, rmsgid, rctrls = self.result3(msgid)
+        waited = time.time() - started
+        msgid = None
+        if stats: stats.page(waited, rdata)
+
+        if max_page_size and rdata:
+          latency = waited / len(rdata)
+          if best_latency is None or latency < best_latency:
+            best_latency = latency
+            req_ctrl.size = min(req_ctrl.size * 2, max_page_size)
+
+        # Extract the simple paged results response control
+        pctrls = [
+          c
+          for c in rctrls
+          if c.controlType == SimplePagedResultsControl.controlType
+        ]
+        cookie = pctrls and pctrls[0].cookie
+        if cookie:
+          # Copy cookie from response control to request control
+          req_ctrl.cookie = cookie
+
+        if cookie and prefetch:
+          msgid = self.search_ext(
+            base,
+            scope,
+            filterstr,
+            attrlist=attrlist,
+            serverctrls=(serverctrls or [])+[req_ctrl]
+          )
+          yield rdata
+        else:
+          yield rdata
+          if cookie:
+            msgid = self.search_ext(
+              base,
+              scope,
+              filterstr,
+              attrlist=attrlist,
+              serverctrls=(serverctrls or [])+[req_ctrl]
+            )
+    finally:
+      # The caller stopped early, drop the page still in flight. A failing
+      # abandon must not hide the exception that got us here
+      if msgid is not None:
+        try:
+          self.abandon(msgid)
+        except ldap.LDAPError:
+          pass
+
+  def paged_search_ext_s(self,base,scope,filterstr='(objectClass=*)',attrlist=None,attrsonly=0,serverctrls=None,clientctrls=None,timeout=-1,sizelimit=0,criticality=True,page_size=1000,prefetch=False,max_page_size=None,stats=None):
+    """
+    Behaves exactly like LDAPObject.search_ext_s() but internally uses the
+    simple paged results control to retrieve search results in chunks.
+    This is non-sense for really large results sets which you would like
+    to process one-by-one, use paged_search_iter() for those.
+    """
+    result_pages = 0
+    all_results = []
+    for rdata in self.paged_search_iter(base,scope,filterstr,attrlist=attrlist,serverctrls=serverctrls,criticality=criticality,page_size=page_size,prefetch=prefetch,max_page_size=max_page_size,stats=stats):
+      all_results.extend(rdata)
+      result_pages += 1
+    return result_pages,all_results
+
+class _MyLDAPObject(LDAPObject,_PagedResultsSearchObject):
+  pass
+
+class LDAPStats(object):
+  """
+  Timers and counters of the work done by LDAPSearch: the connect, bind,
+  page (the wait for each page), search and transform (resultsDict)
+  phases, and the number of connections, pages, entries, bytes (of DNs
+  and values) and retries. Each timer holds [count, total seconds, max
+  seconds]. The timings taken since the last flush() are also kept, up to
+  max_samples per timer, in samples. flush() takes those samples over and
+  hands them with the figures to every sink (any object with an
+  emit(stats, samples) method, ie. StatsDSink or PrometheusSink).
+  """
+
+  def __init__(self, sinks = (), max_samples = 1000):
+    self.sinks = list(sinks)
+    self.max_samples = int(max_samples)
+    self.__lock = threading.Lock()
+    self.__timers = {}
+    self.__counters = {}
+    self.__samples = {}
+
+  def time(self, name, seconds):
+    with self.__lock:
+      timer = self.__timers.get(name)
+      if timer is None:
+        self.__timers[name] = [1, seconds, seconds]
+      else:
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]: timer[2] = seconds
+      sample = self.__samples.setdefault(name, [0, []])
+      sample[0] += 1
+      if len(sample[1]) < self.max_samples: sample[1].append(seconds)
+
+  def count(self, name, n = 1):
+    with self.__lock:
+      self.__counters[name] = self.__counters.get(name, 0) + n
+
+  def page(self, seconds, rdata):
+    """
+    Records one page of results, and the time waited for it if not None.
+    """
+    size = 0
+    for dn, attrs in rdata:
+      size += len(dn or "")
+      if isinstance(attrs, dict):
+        for values in attrs.itervalues():
+          for value in values: size += len(value)
+    if seconds is not None: self.time("page", seconds)
+    with self.__lock:
+      for name, n in (("pages", 1), ("entries", len(rdata)), ("bytes", size)):
+        self.__counters[name] = self.__counters.get(name, 0) + n
+
+  def getTimers(self):
+    with self.__lock:
+      return dict([ (name, list(timer)) for name, timer in self.__timers.items() ])
+  timers = property(getTimers)
+
+  def getSamples(self):
+    """
+    Returns a Dictionary of each timer to the number of timings taken since
+    the last flush() and the List of those kept.
+    """
+    with self.__lock:
+      return dict([ (name, (sample[0], list(sample[1]))) for name, sample in self.__samples.items() ])
+  samples = property(getSamples)
+
+  def getCounters(self):
+    with self.__lock:
+      return self.__counters.copy()
+  counters = property(getCounters)
+
+  def reset(self):
+    with self.__lock:
+      self.__timers = {}
+      self.__counters = {}
+      self.__samples = {}
+
+  def flush(self):
+    with self.__lock:
+      samples, self.__samples = self.__samples, {}
+    samples = dict([ (name, (sample[0], sample[1])) for name, sample in samples.items() ])
+    for sink in self.sinks: sink.emit(self, samples)
+
+  def __str__(self):
+    lines = [ "%-12s %10d" % (name, value) for name, value in sorted(self.counters.items()) ]
+    for name, timer in sorted(self.timers.items()):
+      lines.append("%-12s %10d x %.6fs (max %.6fs)" % (name, timer[0], timer[1] / max(timer[0], 1), timer[2]))
+    return "\n".join(lines)
+
+class StatsDSink(object):
+  """
+  Sends the counters added since the last emit(), and every timing in
+  samples, to a StatsD server as UDP datagrams. Timings beyond
+  max_samples are accounted for with a sample rate. Counters that went
+  down (LDAPStats.reset()) are counted again from zero. Errors are
+  ignored.
+  """
+
+  def __init__(self, host = "127.0.0.1", port = 8125, prefix = "brandt.ldap"):
+    self.address = (host, int(port))
+    self.prefix = prefix
+    self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.__sent = {}
+
+  def emit(self, stats, samples):
+    lines = []
+    for name, value in sorted(stats.counters.items()):
+      sent = self.__sent.get(name, 0)
+      if value < sent: sent = 0
+      self.__sent[name] = value
+      if value > sent: lines.append("%s.%s:%d|c" % (self.prefix, name, value - sent))
+    for name, (count, kept) in sorted(samples.items()):
+      rate = ""
+      if kept and len(kept) < count: rate = "|@%g" % (float(len(kept)) / count)
+      for seconds in kept:
+        lines.append("%s.%s:%.3f|ms%s" % (self.prefix, name, seconds * 1000, rate))
+    while lines:
+      packet = lines.pop(0)
+      while lines and len(packet) + len(lines[0]) < 512: packet += "\n" + lines.pop(0)
+      try:
+        self.__socket.sendto(packet, self.address)
+      except socket.error:
+        pass
+
+class PrometheusSink(object):
+  """
+  Writes the figures in the Prometheus text format to filename (ie. for
+  the node_exporter textfile collector), replacing the file atomically.
+  """
+
+  def __init__(self, filename, prefix = "brandt_ldap"):
+    self.filename = filename
+    self.prefix = prefix
+
+  def emit(self, stats, samples):
+    lines = []
+    for name, value in sorted(stats.counters.items()):
+      lines.append("# TYPE %s_%s_total counter" % (self.prefix, name))
+      lines.append("%s_%s_total %d" % (self.prefix, name, value))
+    for name, timer in sorted(stats.timers.items()):
+      lines.append("# TYPE %s_%s_seconds summary" % (self.prefix, name))
+      lines.append("%s_%s_seconds_sum %f" % (self.prefix, name, timer[1]))
+      lines.append("%s_%s_seconds_count %d" % (self.prefix, name, timer[0]))
+    tmp = "%s.%d" % (self.filename, os.getpid())
+    f = open(tmp, "w")
+    try:
+      f.write("\n".join(lines) + "\n")
+    finally:
+      f.close()
+    os.rename(tmp, self.filename)
+
+class LDAPConnectionPool(object):
+  """
+  Thread safe pool of bound LDAP connections, keyed by scheme, hostport,
+  bind identity and connection options, so repeated searches against the
+  same server do not pay for a connect and bind every time. Passwords are
+  only kept as a salted hash in the keys.
+
+    max_size     = idle connections kept per key, extras are unbound
+    max_idle     = seconds an idle connection is kept before being evicted
+    check_idle   = seconds a connection may sit idle before it is checked
+                   with a rootDSE read when it is handed out again
+  """
+
+  def __init__(self, max_size = 4, max_idle = 300, check_idle = 30):
+    self.max_size = int(max_size)
+    self.max_idle = float(max_idle)
+    self.check_idle = float(check_idle)
+    self.__lock = threading.Lock()
+    self.__idle = {}
+    self.__salt = os.urandom(16)
+    self.__stats = {'hits':0, 'misses':0, 'evictions':0, 'failed':0}
+
+  def __key(self, url, options):
+    cred = hashlib.sha1(self.__salt + (url.cred or '')).hexdigest()
+    return (url.urlscheme, url.hostport, url.who or '', cred, tuple(options))
+
+  def __healthy(self, l):
+    try:
+      l.search_ext_s('', ldap.SCOPE_BASE, '(objectClass=*)', attrlist=['1.1'])
+      return True
+    except ldap.LDAPError:
+      return False
+
+  def __unbind(self, l):
+    try:
+      l.unbind_s()
+    except ldap.LDAPError:
+      pass
+
+  def __evict(self, now):
+    # Called with the lock held, returns the connections to unbind
+    expired = []
+    for key in self.__idle.keys():
+      keep = [ x for x in self.__idle[key] if now - x[1] <= self.max_idle ]
+      expired += [ x[0] for x in self.__idle[key] if now - x[1] > self.max_idle ]
+      if keep:
+        self.__idle[key] = keep
+      else:
+        del self.__idle[key]
+    self.__stats['evictions'] += len(expired)
+    return expired
+
+  def get(self, url, connect, options = ()):
+    """
+    Returns an idle connection for the LDAPUrl url and the options it was
+    made with, or a new one created by calling connect() when there is none
+    (or it failed its health check).
+    """
+    key = self.__key(url, options)
+    while True:
+      now = time.time()
+      with self.__lock:
+        expired = self.__evict(now)
+        l, used = None, now
+        if self.__idle.get(key):
+          l, used = self.__idle[key].pop()
+      for x in expired: self.__unbind(x)
+      if l is None: break
+      if now - used < self.check_idle or self.__healthy(l):
+        with self.__lock: self.__stats['hits'] += 1
+        return l
+      with self.__lock: self.__stats['failed'] += 1
+      self.__unbind(l)
+
+    with self.__lock: self.__stats['misses'] += 1
+    return connect()
+
+  def put(self, url, l, broken = False, options = ()):
+    """
+    Returns a connection to the pool. Broken connections, or connections
+    over max_size, are unbound instead.
+    """
+    key = self.__key(url, options)
+    now = time.time()
+    with self.__lock:
+      expired = self.__evict(now)
+      if not broken and len(self.__idle.get(key, [])) < self.max_size:
+        self.__idle.setdefault(key, []).append((l, now))
+        l = None
+    for x in expired: self.__unbind(x)
+    if l is not None: self.__unbind(l)
+
+  def clear(self):
+    """
+    Unbinds every idle connection.
+    """
+    with self.__lock:
+      idle = [ x[0] for key in self.__idle for x in self.__idle[key] ]
+      self.__idle = {}
+    for l in idle: self.__unbind(l)
+
+  def getStats(self):
+    with self.__lock:
+      stats = self.__stats.copy()
+      stats['idle'] = sum([ len(x) for x in self.__idle.values() ])
+    return stats
+  stats = property(getStats)
+
+ldapPool = LDAPConnectionPool()
+atexit.register(ldapPool.clear)
+
+class LDAPResultCache(object):
+  """
+  Cache of LDAPSearch results keyed on the normalised LDAP URL (scheme,
+  hostport, base, scope, filter, attributes and bind identity). Entries
+  live for ttl seconds in an in memory LRU of at most max_entries, and
+  optionally in a directory on disk holding at most max_files results.
+  Results are kept pickled, so every get() returns a fresh copy which
+  callers may change without affecting the cache.
+
+  Bind passwords only appear in keys as an HMAC under a random secret,
+  kept in directory (as .secret) when there is one. The directory must
+  belong to the user and must not be writable by group or others.
+  """
+
+  def __init__(self, max_entries = 64, ttl = 300, directory = None, max_files = 256):
+    self.max_entries = int(max_entries)
+    self.ttl = float(ttl)
+    self.directory = directory
+    self.max_files = int(max_files)
+    self.__lock = threading.Lock()
+    self.__entries = collections.OrderedDict()
+    self.__stats = {'hits':0, 'disk_hits':0, 'misses':0, 'expired':0, 'evictions':0}
+    self.__secret = os.urandom(32)
+    if directory:
+      if not os.path.isdir(directory): os.makedirs(directory, 0700)
+      st = os.stat(directory)
+      if st.st_uid != os.getuid() or st.st_mode & 022:
+        raise ValueError, "Cache directory %s must be owned by the user and not writable by others." % directory
+      self.__secret = self.__readSecret(os.path.join(directory, ".secret"))
+
+  def __readSecret(self, filename):
+    # Shared by every process using the directory, so disk keys match.
+    # Written aside and linked in, so nobody reads a half written secret
+    if not os.path.exists(filename):
+      tmp = "%s.%d.%d" % (filename, os.getpid(), threading.current_thread().ident)
+      f = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "wb")
+      try:
+        f.write(os.urandom(32))
+      finally:
+        f.close()
+      try:
+        os.link(tmp, filename)
+      except OSError, e:
+        if e.errno != errno.EEXIST: raise
+      finally:
+        os.remove(tmp)
+    f = open(filename, "rb")
+    try:
+      secret = f.read()
+    finally:
+      f.close()
+    if len(secret) != 32: raise ValueError, "Cache secret %s is damaged." % filename
+    return secret
+
+  def key(self, url):
+    attrs = ",".join(sorted([ str(a).lower() for a in (url.attrs or []) ]))
+    cred = hmac.new(self.__secret, str(url.cred or ""), hashlib.sha256).hexdigest()
+    return "\n".join([ str(url.urlscheme).lower(), str(url.hostport).lower(), formatDN(url.dn or ""),
+                       str(url.scope), str(url.filterstr or "(objectClass=*)").strip(), attrs,
+                       formatDN(url.who or ""), cred ])
+
+  def __filename(self, key):
+    return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + ".cache")
+
+  def __readDisk(self, key, now):
+    try:
+      f = open(self.__filename(key), "rb")
+      try:
+        filekey, expires, value = cPickle.load(f)
+      finally:
+        f.close()
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+      return None
+    if filekey != key: return None
+    if expires < now:
+      self.__removeDisk(key)
+      return None
+    return expires, value
+
+  def __writeDisk(self, key, expires, value):
+    filename = self.__filename(key)
+    tmp = "%s.%d.%d" % (filename, os.getpid(), threading.current_thread().ident)
+    f = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "wb")
+    try:
+      cPickle.dump((key, expires, value), f, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      f.close()
+    os.rename(tmp, filename)
+
+    files = [ os.path.join(self.directory, x) for x in os.listdir(self.directory) if x.endswith(".cache") ]
+    if len(files) > self.max_files:
+      files.sort(key = lambda x: os.path.getmtime(x))
+      for x in files[:len(files) - self.max_files]:
+        try:
+          os.remove(x)
+        except OSError:
+          pass
+
+  def __removeDisk(self, key):
+    try:
+      os.remove(self.__filename(key))
+    except OSError:
+      pass
+
+  def get(self, url):
+    """
+    Returns the cached (result_pages, results) for url, or None.
+    """
+    key = self.key(url)
+    now = time.time()
+    with self.__lock:
+      if key in self.__entries:
+        expires, data = self.__entries.pop(key)
+        if expires >= now:
+          self.__entries[key] = (expires, data)
+          self.__stats['hits'] += 1
+          return cPickle.loads(data)
+        self.__stats['expired'] += 1
+      if self.directory:
+        cached = self.__readDisk(key, now)
+        if cached:
+          self.__stats['disk_hits'] += 1
+          self.__store(key, (cached[0], cPickle.dumps(cached[1], cPickle.HIGHEST_PROTOCOL)))
+          return cached[1]
+      self.__stats['misses'] += 1
+    return None
+
+  def __store(self, key, cached):
+    # Called with the lock held
+    self.__entries.pop(key, None)
+    self.__entries[key] = cached
+    while len(self.__entries) > self.max_entries:
+      self.__entries.popitem(last = False)
+      self.__stats['evictions'] += 1
+
+  def put(self, url, value):
+    """
+    Stores the (result_pages, results) of a search of url.
+    """
+    key = self.key(url)
+    expires = time.time() + self.ttl
+    data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    with self.__lock:
+      self.__store(key, (expires, data))
+      if self.directory: self.__writeDisk(key, expires, value)
+
+  def invalidate(self, url = None):
+    """
+    Drops the cached results of url, or everything when url is None.
+    """
+    with self.__lock:
+      if url is None:
+        self.__entries.clear()
+        if self.directory:
+          for x in os.listdir(self.directory):
+            if x.endswith(".cache"): os.remove(os.path.join(self.directory, x))
+      else:
+        key = self.key(url)
+        self.__entries.pop(key, None)
+        if self.directory: self.__removeDisk(key)
+
+  def getStats(self):
+    with self.__lock:
+      stats = self.__stats.copy()
+      stats['entries'] = len(self.__entries)
+    return stats
+  stats = property(getStats)
+
+class LDAPResults(object):
+  """
+  Compact, read only, container for search results. It behaves like the
+  List of (dn, {attr: [values]}) Truples returned by search() but stores
+  the entries column wise: one List of DNs, one of attribute name Truples
+  (interned and shared by every entry with the same attributes) and one
+  of value Truples, where single values are stored bare and repeated
+  multi-value Truples (ie. objectClass) are shared.
+  Entries are rebuilt as (dn, Dictionary) Truples when accessed.
+
+  On a corpus of 100,000 inetOrgPerson entries (cn, sn, givenName, uid,
+  mail, telephoneNumber and 4 objectClass values) this takes about 515
+  bytes per entry against 2,115 bytes for the List of Truples (CPython
+  2.7, 64 bit, including the DN and value strings).
+  """
+
+  def __init__(self, entries = None):
+    self.__dns = []
+    self.__schemas = []
+    self.__values = []
+    self.__shared = {}
+    if entries: self.extend(entries)
+
+  def __share(self, value):
+    return self.__shared.setdefault(value, value)
+
+  def append(self, entry):
+    dn, attrs = entry
+    if not isinstance(attrs, dict):
+      # Search continuation references carry a List of URLs
+      self.__dns.append(dn)
+      self.__schemas.append(None)
+      self.__values.append(tuple(attrs))
+      return
+    schema = tuple(sorted(attrs.keys()))
+    if schema not in self.__shared:
+      schema = self.__share(tuple([ intern(str(attr)) for attr in schema ]))
+    else:
+      schema = self.__shared[schema]
+    values = []
+    for attr in schema:
+      value = attrs[attr]
+      if len(value) == 1:
+        values.append(value[0])
+      else:
+        values.append(self.__share(tuple(value)))
+    self.__dns.append(dn)
+    self.__schemas.append(schema)
+    self.__values.append(tuple(values))
+
+  def extend(self, entries):
+    if isinstance(entries, LDAPResults):
+      for schema in entries.__schemas:
+        if schema is not None: self.__share(schema)
+      self.__dns.extend(entries.__dns)
+      self.__schemas.extend(entries.__schemas)
+      self.__values.extend(entries.__values)
+    else:
+      for entry in entries: self.append(entry)
+
+  def __entry(self, n):
+    schema = self.__schemas[n]
+    if schema is None: return (self.__dns[n], list(self.__values[n]))
+    attrs = {}
+    for attr, value in zip(schema, self.__values[n]):
+      if isinstance(value, tuple):
+        attrs[attr] = list(value)
+      else:
+        attrs[attr] = [value]
+    return (self.__dns[n], attrs)
+
+  def __len__(self):
+    return len(self.__dns)
+
+  def __getitem__(self, n):
+    if isinstance(n, slice):
+      return [ self.__entry(x) for x in range(*n.indices(len(self))) ]
+    if n < 0: n += len(self)
+    if n < 0 or n >= len(self): raise IndexError, "LDAPResults index out of range"
+    return self.__entry(n)
+
+  def __iter__(self):
+    for n in xrange(len(self)):
+      yield self.__entry(n)
+
+  def dns(self):
+    return list(self.__dns)
+
+  def entryDNs(self):
+    """
+    Yields (position, dn) of every entry, references left out, without
+    rebuilding the entries.
+    """
+    for n, (dn, schema) in enumerate(itertools.izip(self.__dns, self.__schemas)):
+      if dn and schema is not None: yield n, dn
+
+  def values(self, attribute):
+    """
+    Yields every value of attribute without rebuilding the entries.
+    """
+    for schema, values in zip(self.__schemas, self.__values):
+      if schema is None or attribute not in schema: continue
+      value = values[schema.index(attribute)]
+      if isinstance(value, tuple):
+        for v in value: yield v
+      else:
+        yield value
+
+def _entryDNs(results):
+  # (position, dn) of the entries of a List or an LDAPResults
+  if isinstance(results, LDAPResults): return results.entryDNs()
+  return ( (n, entry[0]) for n, entry in enumerate(results) if entry and entry[0] and isinstance(entry[1], dict) )
+
+class LDAPIndex(object):
+  """
+  Index over a List (or LDAPResults) of search results. It maps the
+  formatDN() form of every DN to its position in the results, keeps the
+  DN tree so the entries below a DN are found without scanning, and holds
+  case insensitive hash indexes on the chosen attributes. Only positions
+  are stored, the entries themselves stay in the results.
+  """
+
+  __comma = re.compile(r"(?<!\\),")
+
+  def __init__(self, results, attributes = ()):
+    self.__results = results
+    self.__dns = {}
+    self.__tree = {}
+    self.__attrs = {}
+    self.__attributelists = {}
+    for n, dn in _entryDNs(results):
+      dn = formatDN(dn)
+      self.__dns[dn] = n
+      while dn:
+        parent = self.__comma.split(dn, 1)[1:]
+        parent = parent and parent[0] or ""
+        if dn in self.__tree.get(parent, ()): break
+        self.__tree.setdefault(parent, set()).add(dn)
+        dn = parent
+    for attribute in attributes: self.add(attribute)
+
+  def __normalise(self, value):
+    return str(value).strip().lower()
+
+  def add(self, attribute):
+    """
+    Adds a hash index on attribute.
+    """
+    attribute = str(attribute).lower()
+    if attribute in self.__attrs: return
+    index = {}
+    for n, entry in enumerate(self.__results):
+      if not entry or not entry[0]: continue
+      for attr in entry[1]:
+        if attr.lower() == attribute:
+          for value in entry[1][attr]:
+            positions = index.setdefault(self.__normalise(value), [])
+            if not positions or positions[-1] != n: positions.append(n)
+    self.__attrs[attribute] = index
+
+  def attributes(self):
+    return self.__attrs.keys()
+
+  def get(self, dn):
+    """
+    Returns the entry of dn, or None.
+    """
+    n = self.__dns.get(formatDN(dn))
+    if n is None: return None
+    return self.__results[n]
+
+  def find_by(self, attribute, value):
+    """
+    Returns the entries where attribute has value (case insensitive).
+    """
+    attribute = str(attribute).lower()
+    self.add(attribute)
+    return [ self.__results[n] for n in self.__attrs[attribute].get(self.__normalise(value), []) ]
+
+  def children(self, dn, subtree = False):
+    """
+    Returns the entries directly below dn, or every entry below dn when
+    subtree is True.
+    """
+    output = []
+    pending = collections.deque([formatDN(dn)])
+    while pending:
+      for child in sorted(self.__tree.get(pending.popleft(), ())):
+        if child in self.__dns: output.append(self.__results[self.__dns[child]])
+        if subtree: pending.append(child)
+    return output
+
+  def attributelist(self, attribute):
+    if attribute not in self.__attributelists:
+      temp = set()
+      for entry in self.__results:
+        if entry and entry[0] and attribute in entry[1]: temp.update(entry[1][attribute])
+      self.__attributelists[attribute] = tuple(temp)
+    return self.__attributelists[attribute]
+
+class LDAPResultsDict(collections.MutableMapping):
+  """
+  Dictionary of DNs containing a Dictionary of sorted Lists, built lazily
+  over a List (or LDAPResults) of search results, which is never changed.
+  Only the DNs are passed through functDN up front, the attributes and
+  values of an entry are transformed and sorted the first time that entry
+  is read.
+
+  More entries can be added with extend() (kept by the dictionary itself)
+  or, from an iterator such as iter_search(), with pull(): those are only
+  read from the iterator as far as a lookup needs, len() reads it to the
+  end. Entries read are kept, so the memory used grows with them.
+
+  It is not a dict subclass: has_key() and copy() are there as on a dict,
+  but json.dumps() and isinstance(x, dict) need the plain dict returned
+  by copy() (or dict(x)), which transforms every entry.
+  """
+
+  def __init__(self, results, functDN, functAttr, functValue, stats = None):
+    self.__results = results
+    self.__base = len(results)
+    self.__added = []
+    self.__pending = None
+    self.__stats = stats
+    self.__functDN = functDN
+    self.__functAttr = functAttr
+    self.__functValue = functValue
+    self.__positions = {}
+    self.__entries = {}
+    for n, dn in _entryDNs(results): self.__positions[self.__functDN(dn)] = n
+
+  def __position(self, n, entry):
+    if entry and len(entry) == 2 and entry[0] and isinstance(entry[1], dict):
+      dn = self.__functDN(entry[0])
+      self.__positions[dn] = n
+      self.__entries.pop(dn, None)
+      return dn
+    return None
+
+  def __entry(self, n):
+    if n < self.__base: return self.__results[n]
+    return self.__added[n - self.__base]
+
+  def extend(self, entries):
+    """
+    Adds entries to the dictionary (not to the results it was built over).
+    """
+    for entry in entries:
+      self.__added.append(entry)
+      self.__position(self.__base + len(self.__added) - 1, entry)
+
+  def pull(self, entries):
+    """
+    Adds the entries of an iterator, reading them only when needed.
+    """
+    if self.__pending is None:
+      self.__pending = iter(entries)
+    else:
+      self.__pending = itertools.chain(self.__pending, entries)
+
+  def __next(self):
+    # Reads one more entry from the pending iterator, returns its DN (or
+    # None) and False once the iterator is exhausted
+    try:
+      entry = self.__pending.next()
+    except StopIteration:
+      self.__pending = None
+      return None, False
+    self.__added.append(entry)
+    return self.__position(self.__base + len(self.__added) - 1, entry), True
+
+  def __find(self, dn):
+    while dn not in self.__positions and self.__pending is not None:
+      self.__next()
+    return dn in self.__positions
+
+  def __getitem__(self, dn):
+    if not self.__find(dn): raise KeyError, dn
+    if dn not in self.__entries:
+      if self.__stats: started = time.time()
+      attrs = self.__entry(self.__positions[dn])[1]
+      entry = {}
+      for attr in sorted(attrs.keys()):
+        entry[self.__functAttr(attr)] = sorted([ self.__functValue(self.__functAttr(attr), v) for v in attrs[attr] ])
+      self.__entries[dn] = entry
+      if self.__stats: self.__stats.time("transform", time.time() - started)
+    return self.__entries[dn]
+
+  def __setitem__(self, dn, value):
+    self.__find(dn)
+    self.__positions.setdefault(dn, None)
+    self.__entries[dn] = value
+
+  def __delitem__(self, dn):
+    if not self.__find(dn): raise KeyError, dn
+    del self.__positions[dn]
+    self.__entries.pop(dn, None)
+
+  def __contains__(self, dn):
+    return self.__find(dn)
+
+  def has_key(self, dn):
+    return self.__find(dn)
+
+  def copy(self):
+    """
+    Returns a plain dict of every entry.
+    """
+    return dict(self.iteritems())
+
+  def __iter__(self):
+    for dn in list(self.__positions): yield dn
+    more = self.__pending is not None
+    while more:
+      dn, more = self.__next()
+      if dn is not None: yield dn
+
+  def __len__(self):
+    while self.__pending is not None: self.__next()
+    return len(self.__positions)
+
+  def __repr__(self):
+    return repr(dict(self.items()))
+
+class LDAPSearch(object):
+  """ 
+  The class returns a List of a Truples of a String and a Dicionary of a List
+      
+    ldapurl     = ldap[s]://[host[:port]][/base[?[attributes][?[scope][?[filter][?extensions]]]]]
+    scope       = "base" / "one" / "sub"
+    ldap://ldap.opw.ie:389/o=opw?cn,mail?base
+    ldaps://ldap1.opw.ie/ou=userapp,o=opw?cn,mail?sub??bindname=cn=brandtb%2cou=it%2co=opw,X-BINDPW=password
+
+    Every search connects and unbinds unless given an LDAPConnectionPool
+    (or pool = True for the shared ldapPool) to take connections from and
+    return them to. Results of URL searches are kept in cache when given
+    an LDAPResultCache. With
+    compact = True the results are kept in an LDAPResults container. LDIF
+    files are parsed by a pool of workers processes when workers > 1.
+    With stats = True (or an LDAPStats) timers and counters are kept in
+    stats and flushed to its sinks after each search.
+  """
+  
+  def __init__(self, source = None, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None, prefetch = None, max_page_size = None, pool = None, cache = None, compact = False, workers = None, stats = None):
+    self.__source = None
+    self.__type = None
+    self.__sourcename = None
+    self.__result_pages = None
+    self.__results = None 
+    self.__resultsDicts = {}
+    self.__index = None
+    self.__ldap_version = 3
+    self.__trace_level = 0
+    self.__debug_level = 0
+    self.__referrals = False
+    self.__page_size = 1000
+    self.__prefetch = False
+    self.__max_page_size = None
+    self.__pool = pool
+    if pool is True: self.__pool = ldapPool
+    self.__cache = cache
+    self.__compact = bool(compact)
+    self.__workers = int(workers or 1)
+    self.__stats = stats
+    if stats is True: self.__stats = LDAPStats()
+
+    if source != None: self.search(source, ldap_version, trace_level, debug_level, referrals, page_size, prefetch, max_page_size)
+ 
+  def getSource(self):
+    return self.__source
+
+  def setSource(self, source):
+    if str(type(source)) == "<type 'str'>" and source == "stdin":
+      self.__source = sys.stdin
+      self.__type = "stream"
+      self.__sourcename = "stdin"            
+    elif str(type(source)) == "<type 'file'>":
+      self.__source = source
+      self.__type = "file"
+      self.__sourcename = str(source.name).lstrip("<").rstrip(">")
+    elif str(type(source)) == "<type 'str'>":
+      try:
+        self.__source = ldapurl.LDAPUrl(source)
+        self.__type = "url"
+        self.__sourcename = source
+      except:
+        try:
+          self.__source = open(source)
+          self.__type = "file"
+          self.__sourcename = str(source)
+        except:
+          self.__source = None
+          self.__type = None
+          self.__sourcename = None
+          raise ValueError, "Parameter source does not seem to be a LDAP URL or File."
+
+    else:
+      self.__source = None
+      self.__type = None
+      self.__sourcename = None
+      raise ValueError, "Parameter source does not seem to be a LDAP URL or File."
+
+  source = property(getSource, setSource)
+
+  def getType(self):
+    if self.__type != None:
+      return self.__type
+    else:
+      raise ValueError, "Source does not seem to be a LDAP URL or File."
+      return None
+  type=property(getType)
+
+  def getSourceName(self):
+    if self.__sourcename != None:
+      return self.__sourcename
+    else:
+      raise ValueError, "Source does not seem to be a LDAP URL or File."
+      return None
+  sourcename=property(getSourceName)        
+
+  def getresults(self):
+    return self.__results
+  results = property(getresults)
+  result_pages = property(lambda self: self.__result_pages)
+  stats = property(lambda self: self.__stats)
+
+  def __flush(self):
+    if self.__stats: self.__stats.flush()
+
+  def __doNothing(*x): return x[-1]
+
+  def resultsDict(self, functDN = __doNothing, functAttr = __doNothing, functValue = __doNothing, entries = None):
+    """
+    Returns the results as a Dictionary of DNs containing a Dictionary of 
+    sorted Lists (an LDAPResultsDict, which only transforms an entry when
+    it is read; use its copy() where a real dict is needed, ie. for
+    json.dumps()). One is kept per combination of functions. Any iterable of
+    entries (ie. iter_search()) can be passed as entries, they are then
+    used in place of the results and only read as lookups need them (see
+    LDAPResultsDict.pull(), the entries read are kept in memory).
+    """
+    key = (functDN, functAttr, functValue)
+    if entries is not None:
+      resultsDict = LDAPResultsDict([], functDN, functAttr, functValue, self.__stats)
+      resultsDict.pull(entries)
+      self.__resultsDicts[key] = resultsDict
+    elif key not in self.__resultsDicts:
+      if not self.__results: return None
+      self.__resultsDicts[key] = LDAPResultsDict(self.__results, functDN, functAttr, functValue, self.__stats)
+    return self.__resultsDicts[key]
+
+  def __connect(self, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None, prefetch = None, max_page_size = None, url = None):
+    if url is None: url = self.source
+    con_string = "%s://%s" % (url.urlscheme, url.hostport)    
+    self.__setOptions(ldap_version, trace_level, debug_level, referrals, page_size, prefetch, max_page_size)
+
+    def connect():
+      if self.__stats: started = time.time()
+      l = _MyLDAPObject(con_string,trace_level=self.__trace_level)
+      l.protocol_version = self.__ldap_version
+      #l.start_tls_s()
+      if self.__stats:
+        self.__stats.time("connect", time.time() - started)
+        self.__stats.count("connections")
+        started = time.time()
+      if url.who:
+        l.simple_bind_s(url.who, url.cred)
+      else:
+        l.simple_bind_s('', '') # anonymous bind
+      if self.__stats: self.__stats.time("bind", time.time() - started)
+      return l
+
+    if self.__pool: return self.__pool.get(url, connect, self.__options())
+    return connect()
+
+  def __setOptions(self, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None, prefetch = None, max_page_size = None):
+    if ldap_version != None: self.__ldap_version = int(ldap_version)
+    if trace_level != None:  self.__trace_level = int(trace_level)
+    if debug_level != None:  self.__debug_level = int(debug_level)
+    if referrals != None:    self.__referrals = bool(referrals)
+    if page_size != None:    self.__page_size = int(page_size)
+    if prefetch != None:     self.__prefetch = bool(prefetch)
+    if max_page_size != None: self.__max_page_size = int(max_page_size)
+    ldap.set_option(ldap.OPT_DEBUG_LEVEL,self.__debug_level)
+    ldap.set_option(ldap.OPT_REFERRALS, int(self.__referrals))
+
+  def __options(self):
+    # What a pooled connection was made with, besides the URL
+    return (self.__ldap_version, self.__referrals, self.__trace_level)
+
+  def __release(self, l, broken = False, url = None):
+    if url is None: url = self.source
+    if self.__pool:
+      self.__pool.put(url, l, broken, self.__options())
+    else:
+      l.unbind_s()
+
+  def __readLDIF(self, source, type):
+    if self.__workers > 1 and type == "file" and os.path.isfile(source.name):
+      return readLDIFParallel(source.name, self.__workers)
+    return readLDIF(source)
+
+  def search(self, source, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None, prefetch = None, max_page_size = None, use_cache = True, refresh_cache = False):
+    """
+    Searches source and returns the results. With a cache, use_cache = False
+    bypasses it and refresh_cache = True searches again and replaces the
+    cached results.
+    """
+    timeout = 0
+    if self.__stats: started = time.time()
+    self.source = source
+    self.__results = []
+    self.__resultsDicts = {}
+    self.__index = None
+    if self.type == "file" or self.type == "stream":
+      self.__results = self.__container(self.__readLDIF(self.__source, self.__type))
+
+    elif self.type == "url":
+      use_cache = bool(self.__cache and use_cache)
+      if use_cache and not refresh_cache:
+        cached = self.__cache.get(self.source)
+        if cached is not None:
+          self.__result_pages, self.__results = cached
+          return self.__results
+
+      filterstr = self.source.filterstr
+      if filterstr == None: filterstr = "(objectClass=*)"
+      l = self.__connect(ldap_version, trace_level, debug_level, referrals, page_size, prefetch, max_page_size)
+
+      # Send search request
+      try:
+        self.__result_pages, self.__results = self.__searchPartition(l, self.source.dn, self.source.scope, filterstr)
+      except: 
+        exc_type, exc_value, exc_traceback = sys.exc_info()        
+        self.__release(l, broken = True)
+        raise exc_type, exc_value
+
+      self.__release(l)
+      if use_cache: self.__cache.put(self.source, (self.__result_pages, self.__results))
+    if self.__stats:
+      self.__stats.time("search", time.time() - started)
+      self.__flush()
+    return self.__results
+
+  def iter_search(self, source, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None, prefetch = None, max_page_size = None):
+    """
+    Generator version of search(). Entries are yielded page by page as the
+    server returns them and are not kept in results, so memory is bounded
+    by page_size. The connection is unbound once the generator is exhausted
+    or closed. The source and options are read when iter_search() is
+    called, later searches on this object do not change the stream.
+    """
+    self.source = source
+    self.__results = None
+    self.__result_pages = None
+    self.__resultsDicts = {}
+    self.__index = None
+    self.__setOptions(ldap_version, trace_level, debug_level, referrals, page_size, prefetch, max_page_size)
+    if self.type == "file" or self.type == "stream":
+      return self.__iterLDIF(self.__source, self.__type)
+    return self.__iterURL(self.__source, self.__page_size, self.__prefetch, self.__max_page_size)
+
+  def __iterLDIF(self, source, type):
+    for entry in self.__readLDIF(source, type):
+      yield entry
+
+  def __iterURL(self, url, page_size, prefetch, max_page_size):
+    filterstr = url.filterstr
+    if filterstr == None: filterstr = "(objectClass=*)"
+    l = self.__connect(url = url)
+    result_pages = 0
+    broken = False
+    pages = None
+    try:
+      try:
+        pages = l.paged_search_iter(
+          url.dn,
+          url.scope,
+          filterstr,
+          attrlist=url.attrs,
+          serverctrls=None,
+          page_size=page_size,
+          prefetch=prefetch,
+          max_page_size=max_page_size,
+          stats=self.__stats
+        )
+        for rdata in pages:
+          result_pages += 1
+          for entry in rdata:
+            yield entry
+      except ldap.UNAVAILABLE_CRITICAL_EXTENSION:
+        if result_pages: raise
+        if self.__stats: self.__stats.count("retries")
+        for entry in l.search_ext_s(
+            url.dn,
+            url.scope,
+            filterstr,
+            attrlist=url.attrs,
+            serverctrls=None
+          ):
+          yield entry
+    except ldap.LDAPError:
+      broken = True
+      raise
+    finally:
+      # Closed early: have the page in flight abandoned before the
+      # connection goes back to the pool
+      if pages is not None:
+        try:
+          pages.close()
+        except ldap.LDAPError:
+          broken = True
+      self.__release(l, broken, url)
+      self.__flush()
+
+  def __container(self, entries = None):
+    if self.__compact: return LDAPResults(entries)
+    return list(entries or [])
+
+  def __searchPartition(self, l, base, scope, filterstr, attrlist = None):
+    if attrlist is None: attrlist = self.source.attrs
+    results = self.__container()
+    result_pages = 0
+    try:
+      for rdata in l.paged_search_iter(
+          base,
+          scope,
+          filterstr,
+          attrlist=attrlist,
+          serverctrls=None,
+          page_size=self.__page_size,
+          prefetch=self.__prefetch,
+          max_page_size=self.__max_page_size,
+          stats=self.__stats
+        ):
+        results.extend(rdata)
+        result_pages += 1
+    except ldap.UNAVAILABLE_CRITICAL_EXTENSION:
+      if result_pages: raise
+      if self.__stats: self.__stats.count("retries")
+      results.extend(l.search_ext_s(base, scope, filterstr, attrlist=attrlist, serverctrls=None))
+    return result_pages, results
+
+  def parallel_search(self, source, workers = 4, partitions = None, hostports = None, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None, prefetch = None, max_page_size = None):
+    """
+    Splits a "sub" search into partitions and runs them concurrently on
+    up to workers connections, spread round robin over hostports (replicas
+    of the server in source) when given. By default there is one partition
+    per entry directly below the base DN, otherwise partitions is a list
+    of filters which are each ANDed with the filter of the URL. The merged
+    results are in the same form as search() and kept in partition order.
+    """
+    self.source = source
+    if self.type != "url" or self.source.scope != ldap.SCOPE_SUBTREE:
+      return self.search(source, ldap_version, trace_level, debug_level, referrals, page_size, prefetch, max_page_size)
+
+    self.__results = []
+    self.__resultsDicts = {}
+    self.__index = None
+    filterstr = self.source.filterstr
+    if filterstr == None: filterstr = "(objectClass=*)"
+
+    tasks = []
+    l = self.__connect(ldap_version, trace_level, debug_level, referrals, page_size, prefetch, max_page_size)
+    try:
+      if partitions:
+        for partition in partitions:
+          tasks.append( (self.source.dn, ldap.SCOPE_SUBTREE, "(&%s%s)" % (filterstr, partition)) )
+      else:
+        tasks.append( (self.source.dn, ldap.SCOPE_BASE, filterstr) )
+        for entry in self.__searchPartition(l, self.source.dn, ldap.SCOPE_ONELEVEL, "(objectClass=*)", ["1.1"])[1]:
+          if entry[0]: tasks.append( (entry[0], ldap.SCOPE_SUBTREE, filterstr) )
+    except: 
+      exc_type, exc_value, exc_traceback = sys.exc_info()        
+      self.__release(l, broken = True)
+      raise exc_type, exc_value
+    self.__release(l)
+
+    urls = []
+    for hostport in (hostports or [self.source.hostport]):
+      url = copy.copy(self.source)
+      url.hostport = hostport
+      urls.append(url)
+
+    queue = Queue.Queue()
+    for n in range(len(tasks)): queue.put(n)
+    output = [None] * len(tasks)
+    errors = []
+
+    def worker(url):
+      l = None
+      try:
+        l = self.__connect(url = url)
+        while not errors:
+          try:
+            n = queue.get_nowait()
+          except Queue.Empty:
+            break
+          output[n] = self.__searchPartition(l, *tasks[n])
+      except:
+        errors.append(sys.exc_info())
+      if l is not None: self.__release(l, bool(errors), url)
+
+    threads = []
+    for n in range(max(1, min(int(workers), len(tasks)))):
+      threads.append(threading.Thread(target = worker, args = (urls[n % len(urls)],)))
+      threads[-1].setDaemon(True)
+      threads[-1].start()
+    for thread in threads: thread.join()
+    if errors: raise errors[0][0], errors[0][1], errors[0][2]
+
+    self.__results = self.__container()
+    self.__result_pages = 0
+    for pages, results in output:
+      self.__result_pages += pages
+      self.__results.extend(results)
+    self.__flush()
+    return self.__results
+
+  def sync(self, source, snapshot, ldap_version = None, trace_level = None, debug_level = None, referrals = None, page_size = None, prefetch = None, max_page_size = None):
+    """
+    Incremental version of search() for URL sources. The entries of the
+    last run are kept in the file snapshot together with the highest
+    modifyTimestamp seen; later runs only fetch the entries modified since
+    then, plus the DNs (without attributes) to detect deletions. results
+    holds the full, updated, set of entries afterwards. The snapshot is
+    keyed on the URL without its bind password.
+    Returns a Dictionary of the "added", "modified" and "deleted" DNs.
+    """
+    self.source = source
+    if self.type != "url": raise ValueError, "Source does not seem to be a LDAP URL."
+    self.__results = []
+    self.__resultsDicts = {}
+    self.__index = None
+    filterstr = self.source.filterstr
+    if filterstr == None: filterstr = "(objectClass=*)"
+
+    attrlist = list(self.source.attrs or ["*"])
+    stamped = [ x for x in attrlist if x.lower() == "modifytimestamp" ]
+    if not stamped: attrlist.append("modifyTimestamp")
+
+    def stamp(attrs):
+      for attr in attrs.keys():
+        if attr.lower() == "modifytimestamp":
+          if stamped: return attrs[attr][0]
+          return attrs.pop(attr)[0]
+      return ""
+
+    # Never store the bind password; the bind DN still tells snapshots apart
+    url = self.source
+    key = ("%s://%s" % (url.urlscheme, url.hostport), url.who, url.dn, tuple(url.attrs or ()), url.scope, url.filterstr)
+
+    entries, watermark = {}, None
+    try:
+      f = open(snapshot, "rb")
+      try:
+        data = cPickle.load(f)
+      finally:
+        f.close()
+      if data.get("source") == key:
+        entries, watermark = data["entries"], data["watermark"]
+    except (IOError, EOFError, ValueError, KeyError, cPickle.UnpicklingError):
+      pass
+
+    delta = {"added":[], "modified":[], "deleted":[]}
+    l = self.__connect(ldap_version, trace_level, debug_level, referrals, page_size, prefetch, max_page_size)
+    try:
+      if watermark:
+        pages, changed = self.__searchPartition(l, self.source.dn, self.source.scope, "(&%s(modifyTimestamp>=%s))" % (filterstr, watermark), attrlist)
+        dns = set([ dn for dn, attrs in self.__searchPartition(l, self.source.dn, self.source.scope, filterstr, ["1.1"])[1] if dn ])
+        # Entries brought into scope without being modified themselves
+        for dn in dns.difference(entries).difference([ dn for dn, attrs in changed ]):
+          changed.extend(l.search_ext_s(dn, ldap.SCOPE_BASE, filterstr, attrlist=attrlist))
+      else:
+        # No snapshot, or none of its entries carried a modifyTimestamp
+        pages, changed = self.__searchPartition(l, self.source.dn, self.source.scope, filterstr, attrlist)
+        dns = set([ dn for dn, attrs in changed if dn ])
+      for dn in set(entries).difference(dns):
+        delta["deleted"].append(dn)
+        del entries[dn]
+    except: 
+      exc_type, exc_value, exc_traceback = sys.exc_info()        
+      self.__release(l, broken = True)
+      raise exc_type, exc_value
+    self.__release(l)
+
+    self.__result_pages = pages
+    for dn, attrs in changed:
+      if not dn: continue
+      watermark = max(watermark, stamp(attrs))
+      if dn not in entries:
+        delta["added"].append(dn)
+      elif entries[dn] != attrs:
+        delta["modified"].append(dn)
+      entries[dn] = attrs
+
+    tmp = "%s.%d" % (snapshot, os.getpid())
+    f = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "wb")
+    try:
+      cPickle.dump({"source":key, "watermark":watermark, "entries":entries}, f, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      f.close()
+    os.rename(tmp, snapshot)
+
+    self.__results = self.__container(entries.items())
+    self.__flush()
+    return delta
+
+  def index(self, attributes = ()):
+    """
+    Builds (once) the LDAPIndex over the results, with hash indexes on
+    attributes, and returns it.
+    """
+    if self.__index is None: self.__index = LDAPIndex(self.__results or [])
+    for attribute in attributes: self.__index.add(attribute)
+    return self.__index
+
+  def find_by(self, attribute, value):
+    """
+    Returns the entries where attribute has value, case insensitive.
+    """
+    return self.index().find_by(attribute, value)
+
+  def children(self, dn, subtree = False):
+    """
+    Returns the entries directly below dn, or all of them when subtree is
+    True.
+    """
+    return self.index().children(dn, subtree)
+
+  def attributelist(self, attribute, entries = None):
+    if entries is None:
+      if self.__index is not None: return self.__index.attributelist(attribute)
+      entries = self.results
+    if isinstance(entries, LDAPResults): return tuple(set(entries.values(attribute)))
+    temp = {}
+    for entry in entries:
+      for attr in entry[1]:
+        if attr == attribute:
+          for value in entry[1][attr]:
+            temp[value] = value            
+    return tuple( temp.keys() )
+  
+  def iter_multi_search(self, urls, connections = 2, outstanding = 32, page_size = None, errors = None):
+    """
+    Runs the searches of many LDAP URLs at once without a thread per
+    search. Up to connections connections are opened per server and bind
+    identity, each with up to outstanding requests in flight, and the
+    answers are read as they arrive by polling the connection descriptors
+    with select(). Yields (position in urls, results) as each search
+    completes, results being in the same form as search().
+    A failed search does not stop the others: it is appended to the List
+    errors as (position in urls, exc_info) when given one, otherwise the
+    first failure is raised once every other search has finished.
+    """
+    if page_size != None: self.__page_size = int(page_size)
+    queue = collections.deque()
+    for n, url in enumerate(urls):
+      if not isinstance(url, ldapurl.LDAPUrl): url = ldapurl.LDAPUrl(url)
+      queue.append( (n, url) )
+
+    servers = {}
+    failed = []
+    def request(conn, n, url, req_ctrl):
+      filterstr = url.filterstr
+      if filterstr == None: filterstr = "(objectClass=*)"
+      msgid = conn['l'].search_ext(url.dn, url.scope, filterstr, attrlist=url.attrs, serverctrls=req_ctrl and [req_ctrl])
+      conn['inflight'][msgid] = (n, url, req_ctrl)
+
+    def fail(n, conn = None):
+      failed.append( (n, sys.exc_info()) )
+      if conn is None: return
+      conn['results'].pop(n, None)
+      if isinstance(failed[-1][1][1], ldap.SERVER_DOWN): conn['broken'] = True
+
+    broken = False
+    progress = False
+    try:
+      while queue or [ 1 for conns in servers.values() for conn in conns if conn['inflight'] ]:
+        # Hand queued searches to the least busy connection of their server
+        for i in range(len(queue)):
+          n, url = queue.popleft()
+          key = (url.urlscheme, url.hostport, url.who, url.cred)
+          conns = [ conn for conn in servers.setdefault(key, []) if not conn['broken'] ]
+          conn = conns and min(conns, key = lambda x: len(x['inflight']))
+          if not conn or (conn['inflight'] and len(conns) < connections):
+            try:
+              conn = {'l': self.__connect(url = url), 'url': url, 'inflight': {}, 'results': {}, 'broken': False}
+            except ldap.LDAPError:
+              fail(n)
+              continue
+            servers[key].append(conn)
+          if len(conn['inflight']) >= outstanding:
+            queue.append( (n, url) )
+            continue
+          conn['results'][n] = self.__container()
+          try:
+            request(conn, n, url, SimplePagedResultsControl(True, size = self.__page_size, cookie = ''))
+          except ldap.LDAPError:
+            fail(n, conn)
+
+        busy = [ conn for conns in servers.values() for conn in conns if conn['inflight'] ]
+        if not busy: continue
+        # Reading one msgid lets libldap queue the answers to others, which
+        # select() would not see: only wait once a pass got nothing
+        if not progress: select.select([ conn['l'].fileno() for conn in busy ], [], [], 1.0)
+        progress = False
+        for conn in busy:
+          # Polled one msgid at a time, so a failure is tied to its search
+          for msgid in conn['inflight'].keys():
+            n, url, req_ctrl = conn['inflight'][msgid]
+            try:
+              try:
+                rtype, rdata, rmsgid, rctrls = conn['l'].result3(msgid, 1, 0)
+              except ldap.UNAVAILABLE_CRITICAL_EXTENSION:
+                if req_ctrl is None or req_ctrl.cookie: raise
+                # The server does not page, ask again without the control
+                progress = True
+                del conn['inflight'][msgid]
+                if self.__stats: self.__stats.count("retries")
+                request(conn, n, url, None)
+                continue
+            except ldap.LDAPError:
+              progress = True
+              del conn['inflight'][msgid]
+              fail(n, conn)
+              continue
+            if rtype is None: continue
+            progress = True
+            del conn['inflight'][msgid]
+            conn['results'][n].extend(rdata)
+            if self.__stats: self.__stats.page(None, rdata)
+            pctrls = [ c for c in (rctrls or []) if c.controlType == SimplePagedResultsControl.controlType ]
+            if req_ctrl and pctrls and pctrls[0].cookie:
+              req_ctrl.cookie = pctrls[0].cookie
+              try:
+                request(conn, n, url, req_ctrl)
+              except ldap.LDAPError:
+                fail(n, conn)
+            else:
+              yield n, conn['results'].pop(n)
+    except ldap.LDAPError:
+      broken = True
+      raise
+    finally:
+      for conns in servers.values():
+        for conn in conns:
+          for msgid in conn['inflight']:
+            try:
+              conn['l'].abandon(msgid)
+            except ldap.LDAPError:
+              conn['broken'] = True
+          self.__release(conn['l'], broken or conn['broken'] or bool(conn['inflight']), conn['url'])
+      self.__flush()
+
+    if errors is not None:
+      errors.extend(failed)
+    elif failed:
+      raise failed[0][1][0], failed[0][1][1], failed[0][1][2]
+
+  def multi_search(self, urls, connections = 2, outstanding = 32, page_size = None, errors = None):
+    """
+    Returns a List with the results of each of the LDAP URLs, see
+    iter_multi_search(). With a List errors the failed searches are
+    appended to it and left as None in the output.
+    """
+    output = [None] * len(urls)
+    for n, results in self.iter_multi_search(urls, connections, outstanding, page_size, errors):
+      output[n] = results
+    return output
+
+  def batch_search(self, url, attribute, values, width = 50, connections = 2, outstanding = 32, page_size = None):
+    """
+    Resolves many values of attribute below the LDAP URL url in a few
+    requests: the values are escaped and packed width at a time into
+    (|(attribute=value)...) filters, ANDed with the filter of url, and the
+    chunks run concurrently through iter_multi_search(). Returns a
+    Dictionary of each value to its entry, or to None when no entry
+    matched. Values are matched case insensitively, when several entries
+    match a value the first one is kept. When a chunk returns entries that
+    cannot be paired with any of its values by comparing strings (the
+    server matched them under its own matching rules), the values of that
+    chunk still unmatched are looked up again one at a time.
+    """
+    width = int(width)
+    if width < 1: raise ValueError, "Parameter width must be at least 1."
+    if not isinstance(url, ldapurl.LDAPUrl): url = ldapurl.LDAPUrl(url)
+    filterstr = url.filterstr
+    if filterstr == None: filterstr = "(objectClass=*)"
+    attrs = url.attrs
+    if attrs and attribute.lower() not in [ x.lower() for x in attrs ]: attrs = list(attrs) + [attribute]
+
+    output = {}
+    keys = {}
+    for value in values:
+      output[value] = None
+      keys.setdefault(str(value).strip().lower(), []).append(value)
+
+    unique = keys.keys()
+    chunks = []
+    urls = []
+    for n in range(0, len(unique), width):
+      chunks.append(unique[n:n + width])
+      chunk = copy.copy(url)
+      chunk.attrs = attrs
+      chunk.filterstr = "(&%s(|%s))" % (filterstr, "".join([ "(%s=%s)" % (attribute, ldap.filter.escape_filter_chars(x)) for x in unique[n:n + width] ]))
+      urls.append(chunk)
+
+    missing = []
+    for n, results in self.iter_multi_search(urls, connections, outstanding, page_size):
+      chunk = set(chunks[n])
+      unpaired = False
+      for entry in results:
+        if not entry[0]: continue
+        paired = False
+        for attr in entry[1]:
+          if attr.lower() != attribute.lower(): continue
+          for value in entry[1][attr]:
+            x = str(value).strip().lower()
+            if x in chunk: paired = True
+            for key in keys.get(x, []):
+              if output[key] is None: output[key] = entry
+        unpaired = unpaired or not paired
+      if unpaired: missing += [ x for x in chunks[n] if output[keys[x][0]] is None ]
+
+    urls = []
+    for x in missing:
+      single = copy.copy(url)
+      single.attrs = attrs
+      single.filterstr = "(&%s(%s=%s))" % (filterstr, attribute, ldap.filter.escape_filter_chars(x))
+      urls.append(single)
+
+    for n, results in self.iter_multi_search(urls, connections, outstanding, page_size):
+      for entry in results:
+        if not entry[0]: continue
+        for key in keys[missing[n]]: output[key] = entry
+        break
+    return output
+
+  def writeLDIF(self, output, entries = None, cols = 76):
+    """
+    Writes the results, or any iterable of entries (ie. iter_search()), as
+    LDIF to the file object output.
+    """
+    if entries is None: entries = self.results or []
+    return writeLDIF(output, entries, cols)
+
+  def writeTable(self, attributes, output = None, entries = None, **kwargs):
+    """
+    Writes the DN and attributes of the results, or any iterable of
+    entries, as a table to the file object output, see renderTable().
+    """
+    if entries is None: entries = self.results or []
+    kwargs.setdefault('headers', ["dn"] + list(attributes))
+    return renderTable(ldapRows(entries, attributes), output, **kwargs)
+
+  def __str__(self):
+    return "\n".join( str(result) for result in (self.results or []) )
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Persistent syslog logging of the Brandt Common Utilities. brandt imports
+it on first use of SysLog or SysLogHandler, use it through brandt.
+"""
+import os, sys, time, threading, atexit, socket, Queue
+import syslog as SYSLOG
+import logging
+
+from brandt import syslogPriorities, syslogFacilities, syslogOptions
+
+# openlog() settings are process wide, this holds the SysLog they are for
+_openlogLock = threading.Lock()
+_openlogOwner = [None]
+
+class SysLog(object):
+  """
+  Persistent version of syslog(): the ident, facility and options are
+  resolved once and the datagrams are written straight to the syslog
+  socket (address), which stays open. Falls back on the syslog module
+  when the socket can not be opened.
+
+  With buffered = True, log() only queues the lines and a background
+  thread writes them. The queue holds at most queue_size lines, lines
+  logged while it is full are dropped and counted in dropped. Lines
+  logged after close() are dropped and counted too.
+  """
+
+  __months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+  def __init__(self, ident = "", facility = "syslog", options = [], address = "/dev/log", buffered = False, queue_size = 10000):
+    self.ident = str(ident) or os.path.basename(sys.argv[0])
+    self.facility = syslogFacilities.get(str(facility).lower(),0)
+    self.options = 0
+    for opt in options:
+      self.options |= syslogOptions.get(str(opt).lower(),0)
+    self.dropped = 0
+    self.closed = False
+    self.__tag = self.ident
+    if self.options & SYSLOG.LOG_PID: self.__tag += "[%d]" % os.getpid()
+    self.__lock = threading.Lock()
+
+    self.__socket = None
+    try:
+      self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      self.__socket.connect(address)
+    except socket.error:
+      self.__socket = None
+      with _openlogLock: self.__openlog()
+
+    self.__queue = None
+    if buffered:
+      # A stalled syslog daemon must not block the writer (and close()) for ever
+      if self.__socket is not None: self.__socket.settimeout(1.0)
+      self.__queue = Queue.Queue(int(queue_size))
+      self.__thread = threading.Thread(target = self.__writer)
+      self.__thread.setDaemon(True)
+      self.__thread.start()
+      atexit.register(self.close)
+
+  def __openlog(self):
+    # Called with _openlogLock held
+    SYSLOG.openlog(ident = self.ident, logoption = self.options, facility = self.facility)
+    _openlogOwner[0] = self
+
+  def __write(self, priority, line):
+    if self.__socket is None:
+      # openlog() was given LOG_PERROR too, the syslog module echoes the line
+      with _openlogLock:
+        if _openlogOwner[0] is not self: self.__openlog()
+        SYSLOG.syslog(priority, line)
+      return
+    if self.options & SYSLOG.LOG_PERROR: sys.stderr.write("%s: %s\n" % (self.__tag, line))
+    now = time.localtime()
+    packet = "<%d>%s %2d %s %s: %s" % (self.facility | priority, self.__months[now[1] - 1], now[2], time.strftime("%H:%M:%S", now), self.__tag, line)
+    try:
+      self.__socket.send(packet)
+    except socket.error:
+      with self.__lock: self.dropped += 1
+
+  def __writer(self):
+    while True:
+      item = self.__queue.get()
+      try:
+        if item is None: return
+        self.__write(*item)
+      finally:
+        self.__queue.task_done()
+
+  def log(self, message, priority = "info"):
+    """
+    Send a string to syslog and return that same string.
+    """
+    message = str(message)
+    priority = syslogPriorities.get(str(priority).lower(),0)
+    add = ""
+    for line in message.split("\n"):
+      if line:
+        if self.closed:
+          with self.__lock: self.dropped += 1
+        elif self.__queue is None:
+          self.__write(priority, add + line)
+        else:
+          try:
+            self.__queue.put_nowait( (priority, add + line) )
+          except Queue.Full:
+            with self.__lock: self.dropped += 1
+        add = " "
+    return message
+
+  def flush(self):
+    """
+    Waits until every queued line has been written.
+    """
+    if self.__queue is not None: self.__queue.join()
+
+  def close(self):
+    if self.closed: return
+    self.closed = True
+    if self.__queue is not None:
+      self.__queue.put(None)
+      self.__thread.join()
+      self.__queue = None
+    if self.__socket is not None:
+      self.__socket.close()
+      self.__socket = None
+    else:
+      with _openlogLock:
+        if _openlogOwner[0] is self:
+          SYSLOG.closelog()
+          _openlogOwner[0] = None
+
+class SysLogHandler(logging.Handler):
+  """
+  logging.Handler sending records through a SysLog (or a new SysLog built
+  from the keyword arguments). close() only closes a SysLog it built.
+  """
+
+  levels = { logging.CRITICAL:"crit", logging.ERROR:"err", logging.WARNING:"warning",
+             logging.INFO:"info", logging.DEBUG:"debug" }
+
+  def __init__(self, syslog = None, **kwargs):
+    logging.Handler.__init__(self)
+    self.__owned = syslog is None
+    self.syslog = syslog or SysLog(**kwargs)
+
+  def emit(self, record):
+    try:
+      priority = self.levels.get(record.levelno - record.levelno % 10, "debug")
+      self.syslog.log(self.format(record), priority)
+    except Exception:
+      self.handleError(record)
+
+  def flush(self):
+    self.syslog.flush()
+
+  def close(self):
+    if self.__owned: self.syslog.close()
+    logging.Handler.close(self)
@@ -2,8 +2,8 @@
 """
 Python utility for diagnosing Memory leaks and tracking data over time
 """
-import argparse, textwrap, time
-import subprocess
+import argparse, textwrap, time, errno, collections, resource
+import struct, json, mmap, array, gzip, shutil, threading, signal, stat
 
 # Import Brandt Common Utilities
 import sys, os
@@ -17,8 +17,22 @@ args['count'] = 1
 args['delay'] = 1
 args['processes'] = ''
 args['listprocesses'] = False
+args['perpid'] = False
+args['tree'] = False
+args['window'] = 60
+args['rate'] = 10485760
+args['format'] = 'csv'
+args['rotatesize'] = 67108864
+args['rotatetime'] = 86400
+args['sync'] = 10
+args['nocompress'] = False
+args['export'] = ''
+args['daemon'] = False
+args['socket'] = ''
+args['http'] = 0
+args['maxpids'] = 256
 
-version = 0.3
+version = 0.4
 
 class customUsageVersion(argparse.Action):
   def __init__(self, option_strings, dest, **kwargs):
@@ -52,15 +66,29 @@ class customUsageVersion(argparse.Action):
       options.append(("-h, --help",            "Show this help message and exit"))
       options.append(("-v, --version",         "Show program's version number and exit"))
       options.append(("-c, --count COUNT",     "Number of iterations to perform"))
-      options.append(("-d, --delay SECONDS",   "Time in seconds to wait between iterations"))
+      options.append(("-d, --delay SECONDS",   "Time in seconds to wait between iterations (may be fractional)"))
       options.append(("-o, --outputfile FILE", "File to append. (or stdout|stderr)"))
       options.append(("-l, --listprocesses",   "List available processes"))      
+      options.append(("-p, --perpid",          "Track every matching process and report suspect leaks on stderr"))
+      options.append(("-t, --tree",            "With --perpid, also track each process with its descendants"))
+      options.append(("-w, --window SAMPLES",  "Number of samples the growth rate is computed over"))
+      options.append(("-r, --rate BYTES",      "Growth in bytes/hour reported as a suspect leak"))
+      options.append(("-m, --maxpids COUNT",   "Most processes tracked by --perpid and --daemon (0 for no limit)"))
+      options.append(("-f, --format FORMAT",   "Output format: csv or binary (binary needs a file)"))
+      options.append(("--rotatesize BYTES",    "Start a new binary segment after this many bytes"))
+      options.append(("--rotatetime SECONDS",  "Start a new binary segment after this many seconds"))
+      options.append(("--sync SECONDS",        "Flush and fsync the binary output this often"))
+      options.append(("--nocompress",          "Do not gzip closed binary segments"))
+      options.append(("-x, --export FILE",     "Write a binary capture (and its segments) out as CSV"))
+      options.append(("-D, --daemon",          "Sample until stopped, keeping an hour of 1s and a week of 1m samples in memory (samples are only written out if --outputfile is a file)"))
+      options.append(("-s, --socket FILE",     "With --daemon, answer queries on this Unix socket"))
+      options.append(("--http PORT",           "With --daemon, answer queries over HTTP on localhost"))
       options.append(("process",               "Processes to specifically look at"))
       length = max( [ len(option[0]) for option in options ] )
       for option in options:
         description = textwrap.wrap(option[1], (self.__row - length - 5))
         print "  " + option[0].ljust(length) + "   " + description[0]
-      for n in range(1,len(description)): print " " * (length + 5) + description[n]
+        for n in range(1,len(description)): print " " * (length + 5) + description[n]
     exit(self.__exit)
 def command_line_args():
   global args, version
@@ -80,13 +108,83 @@ def command_line_args():
   parser.add_argument('-d', '--delay',
           required=False,
           default=args['delay'],
-          type=int,
+          type=float,
           help="Time in seconds to wait between iterations.")
   parser.add_argument('-l', '--listprocesses',
           required=False,
           default=args['listprocesses'],
           action='store_true',
           help="List available processes.")  
+  parser.add_argument('-p', '--perpid',
+          required=False,
+          default=args['perpid'],
+          action='store_true',
+          help="Track every matching process and report suspect leaks.")
+  parser.add_argument('-t', '--tree',
+          required=False,
+          default=args['tree'],
+          action='store_true',
+          help="Also track each process with its descendants.")
+  parser.add_argument('-w', '--window',
+          required=False,
+          default=args['window'],
+          type=int,
+          help="Number of samples the growth rate is computed over.")
+  parser.add_argument('-r', '--rate',
+          required=False,
+          default=args['rate'],
+          type=float,
+          help="Growth in bytes/hour reported as a suspect leak.")
+  parser.add_argument('-m', '--maxpids',
+          required=False,
+          default=args['maxpids'],
+          type=int,
+          help="Most processes tracked by --perpid and --daemon.")
+  parser.add_argument('-f', '--format',
+          required=False,
+          default=args['format'],
+          choices=['csv','binary'],
+          help="Output format.")
+  parser.add_argument('--rotatesize',
+          required=False,
+          default=args['rotatesize'],
+          type=int,
+          help="Start a new binary segment after this many bytes.")
+  parser.add_argument('--rotatetime',
+          required=False,
+          default=args['rotatetime'],
+          type=float,
+          help="Start a new binary segment after this many seconds.")
+  parser.add_argument('--sync',
+          required=False,
+          default=args['sync'],
+          type=float,
+          help="Flush and fsync the binary output this often.")
+  parser.add_argument('--nocompress',
+          required=False,
+          default=args['nocompress'],
+          action='store_true',
+          help="Do not gzip closed binary segments.")
+  parser.add_argument('-x', '--export',
+          required=False,
+          default=args['export'],
+          type=str,
+          help="Write a binary capture out as CSV.")
+  parser.add_argument('-D', '--daemon',
+          required=False,
+          default=args['daemon'],
+          action='store_true',
+          help="Sample until stopped and answer queries.")
+  parser.add_argument('-s', '--socket',
+          required=False,
+          default=args['socket'],
+          type=str,
+          help="Unix socket to answer queries on.")
+  parser.add_argument('--http',
+          required=False,
+          default=args['http'],
+          type=int,
+          help="Localhost HTTP port to answer queries on.")
   parser.add_argument('processes',
           nargs='*',
           default= args['processes'],
@@ -95,48 +193,779 @@ def command_line_args():
   args.update(vars(parser.parse_args()))
   args['processes'] = [ str(x).lower() for x in args['processes'] ]
   if args['count'] < 1: args['count'] = 1
-  if args['delay'] < 1: args['delay'] = 1
+  if args['delay'] < 0.01: args['delay'] = 0.01
+  if args['window'] < 2: args['window'] = 2
+  if args['tree']: args['perpid'] = True
+  if args['format'] == 'binary' and str(args['outputfile']).lower() in ["stdout","stderr"]:
+    parser.error("binary output needs an --outputfile")
+
+def parse_fields(data):
+  """
+  Parses the "Name:  value kB" lines of /proc files such as meminfo and
+  status into a dictionary, converting kB values to bytes.
+  """
+  info = {}
+  for line in data.splitlines():
+    name, sep, value = line.partition(":")
+    value = value.split()
+    if sep and value and value[0].isdigit(): info[name] = int(value[0]) * (1024 if value[1:] == ["kB"] else 1)
+  return info
+
+class ProcSampler(object):
+  """
+  Reads memory figures straight out of /proc instead of forking free and
+  ps. The per process files of the processes being followed stay open and
+  are re-read on every sample (a seek back to 0 makes the kernel
+  regenerate them), so a tick costs a few reads per process rather than
+  two shells.
+
+  At most max_fds of those files are kept open (a quarter of the open
+  files limit by default), the least recently read being closed first.
+  When the process runs out of file descriptors anyway, half of them are
+  closed and max_fds lowered to match before trying again.
+  """
+
+  def __init__(self, proc = "/proc", max_fds = None):
+    self.__proc = proc
+    self.pagesize = os.sysconf("SC_PAGE_SIZE")
+    if max_fds is None: max_fds = min(resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 4, 1024)
+    self.max_fds = max(int(max_fds), 0)
+    self.__handles = collections.OrderedDict()
+    self.__denied = set()
+    self.__comms = {}
+    self.__meminfo = self.__retry(os.open, os.path.join(proc, "meminfo"), os.O_RDONLY)
+
+  def __read(self, fd, size = 4096):
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.read(fd, size)
+
+  def __close(self, fd):
+    try:
+      os.close(fd)
+    except OSError:
+      pass
+
+  def __trim(self):
+    while len(self.__handles) > self.max_fds:
+      self.__close(self.__handles.popitem(last = False)[1])
+
+  def __retry(self, function, *args):
+    # Out of file descriptors: shed half of the cached ones and try again
+    while True:
+      try:
+        return function(*args)
+      except OSError as e:
+        if e.errno not in (errno.EMFILE, errno.ENFILE) or not self.__handles: raise
+        self.max_fds = len(self.__handles) // 2
+        self.__trim()
+
+  def __drop(self, pid):
+    for key in [ key for key in self.__handles if key[0] == pid ]:
+      self.__close(self.__handles.pop(key))
+
+  def __readpid(self, pid, name, keep = True):
+    # A kept handle is bound to the process that was running when it was
+    # opened, so a vanished (or recycled) pid fails here and is reopened
+    # once. Files we are not allowed to read are remembered.
+    key = (pid, name)
+    if key in self.__denied: return None
+    for attempt in range(2):
+      fd = self.__handles.pop(key, None)
+      try:
+        if fd is None: fd = self.__retry(os.open, os.path.join(self.__proc, str(pid), name), os.O_RDONLY)
+        data = self.__read(fd)
+      except OSError as e:
+        if fd is not None: self.__close(fd)
+        if e.errno in (errno.EMFILE, errno.ENFILE): raise
+        if e.errno in (errno.EACCES, errno.EPERM):
+          self.__denied.add(key)
+          return None
+        continue
+      if not data or not keep or not self.max_fds:
+        self.__close(fd)
+        if not data: continue
+      else:
+        self.__handles[key] = fd
+        self.__trim()
+      return data
+    return None
+
+  def meminfo(self):
+    """
+    Returns /proc/meminfo as a dictionary of values in bytes.
+    """
+    return parse_fields(self.__read(self.__meminfo, 65536))
+
+  def memory(self):
+    """
+    Returns the memory and swap dictionaries get_data() has always filled
+    from free -b.
+    """
+    info = self.meminfo()
+    cached = info.get("Cached", 0) + info.get("SReclaimable", 0)
+    memory = { 'total':info.get("MemTotal", 0), 'free':info.get("MemFree", 0),
+               'shared':info.get("Shmem", 0), 'buffers':info.get("Buffers", 0), 'cached':cached }
+    memory['used'] = memory['total'] - memory['free'] - memory['buffers'] - cached
+    swap = { 'total':info.get("SwapTotal", 0), 'free':info.get("SwapFree", 0) }
+    swap['used'] = swap['total'] - swap['free']
+    return memory, swap
+
+  def pids(self):
+    """
+    Returns the pids currently in /proc, forgetting what is held for
+    those which have exited.
+    """
+    pids = set( int(x) for x in self.__retry(os.listdir, self.__proc) if x.isdigit() )
+    for pid in set( key[0] for key in self.__handles ) - pids: self.__drop(pid)
+    self.__denied = set( key for key in self.__denied if key[0] in pids )
+    for pid in set(self.__comms) - pids: del self.__comms[pid]
+    return sorted(pids)
+
+  def comm(self, pid):
+    """
+    Returns the command name of pid, or None if it has exited. It is only
+    read once per pid (open, read, close).
+    """
+    if pid not in self.__comms:
+      data = self.__readpid(pid, "comm", keep = False)
+      if data is None: return None
+      self.__comms[pid] = data.rstrip("\n")
+    return self.__comms[pid]
+
+  def statm(self, pid):
+    """
+    Returns /proc/<pid>/statm (size, resident, shared, text, lib, data, dt)
+    in bytes, or None if the process has exited.
+    """
+    data = self.__readpid(pid, "statm")
+    if data is None: return None
+    return tuple( int(x) * self.pagesize for x in data.split() )
+
+  def ppid(self, pid):
+    """
+    Returns the parent pid of pid, or None if it has exited. Trees need it
+    for every process, so stat is opened, read and closed each time.
+    """
+    data = self.__readpid(pid, "stat", keep = False)
+    if data is None: return None
+    return int(data.rsplit(")", 1)[1].split()[1])
+
+  def usage(self, pid):
+    """
+    Returns the rss, pss and swap of pid in bytes, or None if it has
+    exited. The pss comes from smaps_rollup and is only available for the
+    processes we may trace; the rss stands in for it otherwise. Only one
+    of the two files is kept open per process, within max_fds.
+    """
+    data = self.__readpid(pid, "smaps_rollup")
+    if data is not None:
+      info = parse_fields(data)
+      if "Pss" in info: return { 'rss':info.get("Rss", 0), 'pss':info["Pss"], 'swap':info.get("Swap", 0) }
+    data = self.__readpid(pid, "status", keep = data is None)
+    if data is None: return None
+    info = parse_fields(data)
+    return { 'rss':info.get("VmRSS", 0), 'pss':info.get("VmRSS", 0), 'swap':info.get("VmSwap", 0) }
+
+  def processes(self):
+    """
+    Yields (pid, command name) for every running process.
+    """
+    for pid in self.pids():
+      comm = self.comm(pid)
+      if comm is not None: yield pid, comm
+
+  def close(self):
+    while self.__handles: self.__close(self.__handles.popitem()[1])
+    if self.__meminfo is not None:
+      os.close(self.__meminfo)
+      self.__meminfo = None
+
+class LeakSlope(object):
+  """
+  Least squares fit of the last window samples of one series, kept as
+  running sums so adding a sample costs the same however long the capture
+  runs. slope is in units per second.
+  """
+
+  def __init__(self, window = 60):
+    self.window = max(int(window), 2)
+    self.__samples = collections.deque()
+    self.__origin = None
+    self.__rebase()
+
+  def __rebase(self):
+    # Times are kept relative to the oldest sample so the sums stay small;
+    # recomputing them here also sheds any rounding picked up by subtracting.
+    if self.__samples: self.__origin = self.__samples[0][0]
+    self.__evicted = 0
+    self.__n = self.__t = self.__y = self.__tt = self.__ty = self.__yy = 0.0
+    for t, y in self.__samples: self.__sum(t - self.__origin, y, 1)
+
+  def __sum(self, t, y, sign):
+    self.__n += sign
+    self.__t += sign * t
+    self.__y += sign * y
+    self.__tt += sign * t * t
+    self.__ty += sign * t * y
+    self.__yy += sign * y * y
+
+  def add(self, t, y):
+    if self.__origin is None: self.__origin = t
+    self.__samples.append( (t, y) )
+    self.__sum(t - self.__origin, y, 1)
+    if len(self.__samples) > self.window:
+      old_t, old_y = self.__samples.popleft()
+      self.__sum(old_t - self.__origin, old_y, -1)
+      self.__evicted += 1
+      if self.__evicted >= self.window: self.__rebase()
+
+  def __len__(self):
+    return len(self.__samples)
+
+  @property
+  def slope(self):
+    d = self.__n * self.__tt - self.__t * self.__t
+    if self.__n < 2 or d <= 0: return 0.0
+    return (self.__n * self.__ty - self.__t * self.__y) / d
+
+  @property
+  def r2(self):
+    """
+    Coefficient of determination of the fit: near 1 for steady growth,
+    near 0 for noise.
+    """
+    dt = self.__n * self.__tt - self.__t * self.__t
+    dy = self.__n * self.__yy - self.__y * self.__y
+    if self.__n < 2 or dt <= 0 or dy <= 0: return 0.0
+    c = self.__n * self.__ty - self.__t * self.__y
+    return c * c / (dt * dy)
+
+  @property
+  def last(self):
+    if self.__samples: return self.__samples[-1][1]
+    return None
+
+class LeakTracker(object):
+  """
+  Tracks the rss, pss and swap of every process whose command name
+  contains one of processes (every process if processes is empty), and
+  with trees = True the totals of each such process and its descendants.
+  A series is a suspect leak once it has min_samples samples and grows
+  faster than rate bytes/hour with an r2 of at least min_r2. Series of
+  processes which exit are forgotten.
+
+  At most max_pids matching processes are followed (None for no limit),
+  those already followed first; skipped holds how many were left out by
+  the last update().
+  """
+
+  metrics = ('rss', 'pss', 'swap')
+
+  def __init__(self, sampler, processes = [], window = 60, rate = 10485760, trees = False, min_samples = None, min_r2 = 0.5, max_pids = 256):
+    self.sampler = sampler
+    self.processes = [ str(x).lower() for x in processes ]
+    self.window = int(window)
+    self.rate = float(rate)
+    self.trees = bool(trees)
+    self.min_samples = int(min_samples or max(self.window // 2, 3))
+    self.min_r2 = float(min_r2)
+    self.max_pids = int(max_pids) if max_pids else None
+    self.skipped = 0
+    self.__series = {}
+    self.__suspects = set()
+
+  def __match(self, comm):
+    comm = comm.lower()
+    if not self.processes: return True
+    for process in self.processes:
+      if process in comm: return True
+    return False
+
+  def __add(self, key, tick, usage):
+    series = self.__series.get(key)
+    if series is None:
+      series = self.__series[key] = dict( (m, LeakSlope(self.window)) for m in self.metrics )
+    for m in self.metrics: series[m].add(tick, usage[m])
+
+  def update(self, tick = None):
+    """
+    Takes one sample of every tracked process (and tree) and returns the
+    reports of the series which have just become suspect leaks.
+    """
+    if tick is None: tick = time.time()
+    comms, usages, children = {}, {}, {}
+    for pid, comm in self.sampler.processes():
+      comms[pid] = comm
+      if self.trees:
+        ppid = self.sampler.ppid(pid)
+        if ppid is not None: children.setdefault(ppid, []).append(pid)
+
+    matched = set( pid for pid in comms if self.__match(comms[pid]) )
+    self.skipped = 0
+    if self.max_pids and len(matched) > self.max_pids:
+      followed = matched & set( key[1] for key in self.__series )
+      keep = sorted(followed)[:self.max_pids]
+      keep += sorted(matched - followed)[:self.max_pids - len(keep)]
+      self.skipped = len(matched) - len(keep)
+      matched = set(keep)
+    tracked = set(matched)
+    if self.trees:
+      for pid in matched:
+        stack = list(children.get(pid, []))
+        while stack:
+          child = stack.pop()
+          tracked.add(child)
+          stack.extend(children.get(child, []))
+    for pid in tracked:
+      usage = self.sampler.usage(pid)
+      if usage is not None: usages[pid] = usage
+
+    keys = set()
+    for pid in matched:
+      if pid not in usages: continue
+      key = ('pid', pid, comms[pid])
+      self.__add(key, tick, usages[pid])
+      keys.add(key)
+    if self.trees:
+      # A tree is rooted at a matching process whose parent does not match
+      parents = dict( (child, ppid) for ppid in children for child in children[ppid] )
+      for pid in matched:
+        if parents.get(pid) in matched or pid not in usages: continue
+        total = dict( (m, 0) for m in self.metrics )
+        stack = [pid]
+        while stack:
+          p = stack.pop()
+          for m in self.metrics: total[m] += usages.get(p, {}).get(m, 0)
+          stack.extend(children.get(p, []))
+        key = ('tree', pid, comms[pid])
+        self.__add(key, tick, total)
+        keys.add(key)
+
+    for key in set(self.__series) - keys:
+      del self.__series[key]
+    self.__suspects &= keys
+
+    reports = []
+    for report in self.report():
+      if report['suspect'] and report['key'] not in self.__suspects:
+        self.__suspects.add(report['key'])
+        reports.append(report)
+    return reports
+
+  def report(self):
+    """
+    Returns one report per tracked series and metric, fastest growing
+    first: key, kind ('pid' or 'tree'), pid, name, metric, last value,
+    samples, slope (bytes/hour), r2 and suspect.
+    """
+    reports = []
+    for key, series in self.__series.items():
+      for m in self.metrics:
+        fit = series[m]
+        slope = fit.slope * 3600
+        suspect = len(fit) >= self.min_samples and slope >= self.rate and fit.r2 >= self.min_r2
+        reports.append( { 'key':key, 'kind':key[0], 'pid':key[1], 'name':key[2], 'metric':m,
+                          'last':fit.last, 'samples':len(fit), 'slope':slope, 'r2':fit.r2, 'suspect':suspect } )
+    return sorted(reports, key = lambda r: -r['slope'])
+
+def format_report(report):
+  return "%s %d (%s) %s %d bytes, growing %.0f bytes/hour over %d samples (r2 %.2f)" % (
+         report['kind'], report['pid'], report['name'], report['metric'], report['last'],
+         report['slope'], report['samples'], report['r2'])
+
+class BinaryWriter(object):
+  """
+  Appends fixed width records (the sample time then one little endian
+  double per column) to filename. The file starts with a small header
+  naming the columns, see BinaryCapture.
+
+  Records are buffered and flushed and fsynced every sync seconds. Once
+  the file holds rotate_size bytes or rotate_time seconds of samples it
+  is renamed to filename.YYYYmmdd-HHMMSS and, with compress = True,
+  gzipped by a background thread while sampling carries on.
+  """
+
+  magic = "MEMLEAK\x01"
+
+  def __init__(self, filename, columns, rotate_size = 67108864, rotate_time = 86400, sync = 10, compress = True):
+    self.filename = str(filename)
+    self.columns = ['time'] + [ str(c) for c in columns ]
+    self.rotate_size = int(rotate_size)
+    self.rotate_time = float(rotate_time)
+    self.sync = float(sync)
+    self.compress = bool(compress)
+    self.__struct = struct.Struct("<%dd" % len(self.columns))
+    self.__file = None
+    self.__compressors = []
+    self.__open()
+
+  def __header(self):
+    header = json.dumps({ 'columns':self.columns, 'format':self.__struct.format })
+    size = len(self.magic) + 4 + len(header)
+    header += " " * (-size % 64)
+    return self.magic + struct.pack("<I", len(header)) + header
+
+  def __open(self):
+    header = self.__header()
+    if os.path.isfile(self.filename) and os.path.getsize(self.filename) > 0:
+      with open(self.filename, 'rb') as f: existing = f.read(len(header))
+      if existing != header:
+        self.__rotate()
+      else:
+        # Drop a partial record left by a crash
+        size = os.path.getsize(self.filename)
+        whole = len(header) + (size - len(header)) // self.__struct.size * self.__struct.size
+        if whole != size:
+          with open(self.filename, 'r+b') as f: f.truncate(whole)
+    self.__file = open(self.filename, 'ab', 1048576)
+    if self.__file.tell() == 0: self.__file.write(header)
+    self.__started = None
+    self.__synced = time.time()
+
+  def __rotate(self):
+    if self.__file is not None:
+      self.__file.flush()
+      os.fsync(self.__file.fileno())
+      self.__file.close()
+      self.__file = None
+    name = self.filename + "." + time.strftime("%Y%m%d-%H%M%S")
+    n = 0
+    while os.path.exists(name) or os.path.exists(name + ".gz"):
+      n += 1
+      name = self.filename + "." + time.strftime("%Y%m%d-%H%M%S") + "-%d" % n
+    os.rename(self.filename, name)
+    if self.compress:
+      thread = threading.Thread(target = self.__compress, args = (name,))
+      thread.start()
+      self.__compressors = [ t for t in self.__compressors if t.is_alive() ] + [thread]
+
+  def __compress(self, name):
+    with open(name, 'rb') as src:
+      with gzip.open(name + ".gz.tmp", 'wb') as dst: shutil.copyfileobj(src, dst, 1048576)
+    os.rename(name + ".gz.tmp", name + ".gz")
+    os.remove(name)
+
+  def write(self, tick, values):
+    if self.__started is None: self.__started = tick
+    elif (self.rotate_size and self.__file.tell() >= self.rotate_size) or (self.rotate_time and tick - self.__started >= self.rotate_time):
+      self.__rotate()
+      self.__open()
+      self.__started = tick
+    self.__file.write(self.__struct.pack(tick, *values))
+    if time.time() - self.__synced >= self.sync:
+      self.__file.flush()
+      os.fsync(self.__file.fileno())
+      self.__synced = time.time()
+
+  def close(self):
+    if self.__file is not None:
+      self.__file.flush()
+      os.fsync(self.__file.fileno())
+      self.__file.close()
+      self.__file = None
+    for thread in self.__compressors: thread.join()
+
+class BinaryCapture(object):
+  """
+  Reads a file written by BinaryWriter, memory mapped (gzipped segments
+  are read into memory instead). The records start at offset, so NumPy
+  users can also map it directly:
+    numpy.memmap(filename, '<f8', 'r', capture.offset).reshape(-1, len(capture.columns))
+  """
+
+  def __init__(self, filename):
+    self.filename = str(filename)
+    if self.filename.endswith(".gz"):
+      with gzip.open(self.filename, 'rb') as f: self.__buffer = f.read()
+    else:
+      with open(self.filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+          self.__buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+          self.__buffer = ""
+    magic = BinaryWriter.magic
+    if self.__buffer[:len(magic)] != magic: raise ValueError, self.filename + " is not a memoryleak capture."
+    size = struct.unpack_from("<I", self.__buffer, len(magic))[0]
+    header = json.loads(self.__buffer[len(magic) + 4:len(magic) + 4 + size])
+    self.columns = [ str(c) for c in header['columns'] ]
+    self.__struct = struct.Struct(str(header['format']))
+    self.offset = len(magic) + 4 + size
+    self.__count = (len(self.__buffer) - self.offset) // self.__struct.size
+
+  @staticmethod
+  def segments(filename):
+    """
+    Returns the closed segments of a capture, oldest first, then the
+    capture itself.
+    """
+    directory, base = os.path.split(os.path.abspath(str(filename)))
+    def order(name):
+      # base.YYYYmmdd-HHMMSS[-n][.gz]
+      stamp = name[len(base) + 1:].split(".")[0].split("-")
+      return stamp[:2], int(stamp[2]) if len(stamp) > 2 and stamp[2].isdigit() else 0
+    names = sorted( (x for x in os.listdir(directory) if x.startswith(base + ".") and not x.endswith(".tmp")), key = order )
+    names = [ os.path.join(directory, x) for x in names ]
+    if os.path.isfile(filename): names.append(filename)
+    return names
+
+  def __len__(self):
+    return self.__count
+
+  def __getitem__(self, index):
+    if index < 0: index += self.__count
+    if not 0 <= index < self.__count: raise IndexError, "record index out of range"
+    return self.__struct.unpack_from(self.__buffer, self.offset + index * self.__struct.size)
+
+  def __iter__(self):
+    for i in xrange(self.__count): yield self[i]
+
+  def column(self, name):
+    """
+    Returns the values of one column as an array of doubles.
+    """
+    values = array.array('d')
+    values.fromstring(self.__buffer[self.offset:self.offset + self.__count * self.__struct.size])
+    if sys.byteorder == "big": values.byteswap()
+    return values[self.columns.index(name)::len(self.columns)]
+
+  def csv(self, output, header = True):
+    """
+    Writes the capture to the file object output in the CSV format of the
+    text captures.
+    """
+    if header: output.write(",".join(['date'] + self.columns[1:]) + "\n")
+    for record in self:
+      date = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record[0]))
+      if record[0] % 1: date += ".%03d" % (record[0] % 1 * 1000)
+      output.write(",".join([date] + [ "%.15g" % x for x in record[1:] ]) + "\n")
+
+  def close(self):
+    if isinstance(self.__buffer, mmap.mmap): self.__buffer.close()
+    self.__buffer = ""
+
+class RingBuffer(object):
+  """
+  The last size samples at one resolution (in seconds): samples falling
+  in the same resolution long bucket are averaged into one row.
+  """
+
+  def __init__(self, resolution, size):
+    self.resolution = float(resolution)
+    self.rows = collections.deque(maxlen = int(size))
+    self.__bucket = None
+
+  def add(self, tick, values):
+    bucket = tick // self.resolution * self.resolution
+    if self.__bucket is not None and bucket != self.__bucket: self.__close()
+    if self.__bucket is None:
+      self.__bucket = bucket
+      self.__count = 0
+      self.__sums = [0.0] * len(values)
+    self.__count += 1
+    for i, value in enumerate(values): self.__sums[i] += value
+
+  def __close(self):
+    self.rows.append( [self.__bucket] + [ x / self.__count for x in self.__sums ] )
+    self.__bucket = None
+
+  def range(self, start, end):
+    return [ row for row in self.rows if start <= row[0] <= end ]
+
+  @property
+  def oldest(self):
+    if self.rows: return self.rows[0][0]
+    return None
+
+class MemoryDaemon(object):
+  """
+  Keeps the samples of a long running capture in memory, downsampled into
+  one RingBuffer per (resolution, size) tier, and answers the queries of
+  the socket and HTTP servers:
+    current               the latest sample
+    range start end [res] the rows between two times, from the finest
+                          tier reaching back to start (or resolution res)
+    top [n]               the n fastest growing tracked processes
+  """
+
+  def __init__(self, columns, tracker = None, tiers = ((1, 3600), (60, 10080))):
+    self.columns = list(columns)
+    self.tracker = tracker
+    self.tiers = [ RingBuffer(resolution, size) for resolution, size in sorted(tiers) ]
+    self.latest = None
+    self.lock = threading.Lock()
+
+  def add(self, tick, values):
+    with self.lock:
+      self.latest = [tick] + list(values)
+      for tier in self.tiers: tier.add(tick, values)
+
+  def update(self, tick):
+    if self.tracker is None: return []
+    with self.lock: return self.tracker.update(tick)
+
+  def query(self, command, params = []):
+    with self.lock:
+      if command == "current":
+        if self.latest is None: return { 'time':None, 'values':{} }
+        return { 'time':self.latest[0], 'values':dict(zip(self.columns, self.latest[1:])) }
+      if command == "range":
+        start = float(params[0]) if len(params) > 0 else 0.0
+        end = float(params[1]) if len(params) > 1 else time.time()
+        tier = self.tiers[-1]
+        if len(params) > 2:
+          candidates = [ t for t in self.tiers if t.resolution >= float(params[2]) ]
+          if candidates: tier = candidates[0]
+        else:
+          # The finest tier reaching back to start, or else the one reaching furthest
+          filled = [ t for t in self.tiers if t.oldest is not None ]
+          covering = [ t for t in filled if t.oldest <= start ]
+          if covering: tier = covering[0]
+          elif filled: tier = min(filled, key = lambda t: t.oldest)
+        return { 'columns':['time'] + self.columns, 'resolution':tier.resolution, 'rows':tier.range(start, end) }
+      if command == "top":
+        n = int(params[0]) if params else 10
+        if self.tracker is None: return { 'growers':[] }
+        growers = [ dict( (k, v) for k, v in r.items() if k != 'key' ) for r in self.tracker.report() if r['metric'] == 'pss' ]
+        return { 'growers':growers[:n] }
+    raise ValueError, "Unknown query: " + str(command)
+
+def remove_stale_socket(path):
+  """
+  Removes path if it is a Unix socket nobody answers on, left behind by a
+  daemon which died. Raises IOError if it is anything else, or in use.
+  """
+  import socket
+  try:
+    info = os.lstat(path)
+  except OSError as e:
+    if e.errno == errno.ENOENT: return
+    raise
+  if not stat.S_ISSOCK(info.st_mode): raise IOError, path + " exists and is not a socket."
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(path)
+  except socket.error:
+    os.remove(path)
+    return
+  finally:
+    s.close()
+  raise IOError, path + " is in use by another daemon."
+
+def serve(daemon, socket_path = None, http_port = None):
+  """
+  Starts the query servers of daemon in background threads and returns
+  them, call shutdown() and server_close() on each to stop them.
+  """
+  # Only daemons need the server modules, so they are not imported up front
+  import SocketServer, BaseHTTPServer, urlparse
+
+  class _SocketHandler(SocketServer.StreamRequestHandler):
+    # One query per line ("range 1380000000 1380003600"), one JSON answer per line
+    def handle(self):
+      for line in iter(self.rfile.readline, ""):
+        words = line.split()
+        if not words: continue
+        try:
+          answer = self.server.daemon.query(words[0].lower(), words[1:])
+        except Exception as e:
+          answer = { 'error':str(e) }
+        self.wfile.write(json.dumps(answer) + "\n")
+        self.wfile.flush()
+
+  class _SocketServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+  class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # GET /current, /range?start=..&end=..&resolution=.., /top?n=..
+    def do_GET(self):
+      url = urlparse.urlparse(self.path)
+      query = dict( (k, v[-1]) for k, v in urlparse.parse_qs(url.query).items() )
+      command = url.path.strip("/").lower()
+      if command == "range":
+        params = [ query.get('start', 0), query.get('end', time.time()) ]
+        if 'resolution' in query: params.append(query['resolution'])
+      else:
+        params = [ query['n'] ] if 'n' in query else []
+      try:
+        body, status = json.dumps(self.server.daemon.query(command, params)), 200
+      except Exception as e:
+        body, status = json.dumps({ 'error':str(e) }), 400
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+  servers = []
+  if socket_path:
+    remove_stale_socket(socket_path)
+    server = _SocketServer(socket_path, _SocketHandler)
+    info = os.lstat(socket_path)
+    server.inode = (info.st_dev, info.st_ino)
+    servers.append(server)
+  if http_port:
+    servers.append(_HTTPServer(("127.0.0.1", int(http_port)), _HTTPHandler))
+  for server in servers:
+    server.daemon = daemon
+    thread = threading.Thread(target = server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+  return servers
+
+sampler = None
+def get_sampler():
+  global sampler
+  if sampler is None: sampler = ProcSampler()
+  return sampler
+
+def schedule(count, delay):
+  """
+  Yields count tick times, delay seconds apart on a fixed grid so the time
+  spent sampling does not accumulate as drift. Ticks missed because a
+  sample overran are skipped rather than run back to back. A count of
+  None yields ticks for ever.
+  """
+  tick = time.time()
+  c = 0
+  while count is None or c < count:
+    c += 1
+    now = time.time()
+    if tick > now: time.sleep(tick - now)
+    yield tick
+    tick += delay
+    now = time.time()
+    if now > tick: tick += ((now - tick) // delay + 1) * delay
 
 def list_processes():
-  command='ps -A --sort -rss -o comm | sort -uf'
-  p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  out, err = p.communicate()
-  if err: raise IOError(err)
-  return out
+  names = {}
+  for pid, comm in get_sampler().processes():
+    names.setdefault(comm.lower(), comm)
+  return "\n".join( names[x] for x in sorted(names) )
 
 def get_data(memory, swap, processes):
-  command = 'free -b'
-  p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  out, err = p.communicate()
-  if err: raise IOError(err)
-  for line in out.split('\n'):
-    if line: 
-      tmp = line.split()
-      if tmp[0].lower()[:3] == "mem":  
-        if len(tmp) > 1: memory['total'] = int(tmp[1])
-        if len(tmp) > 2: memory['used'] = int(tmp[2])
-        if len(tmp) > 3: memory['free'] = int(tmp[3])
-        if len(tmp) > 4: memory['shared'] = int(tmp[4])
-        if len(tmp) > 5: memory['buffers'] = int(tmp[5])
-        if len(tmp) > 6: memory['cached'] = int(tmp[6])
-      if tmp[0].lower()[:4] == "swap":
-        if len(tmp) > 1: swap['total'] = int(tmp[1])
-        if len(tmp) > 2: swap['used'] = int(tmp[2])
-        if len(tmp) > 3: swap['free'] = int(tmp[3])
+  s = get_sampler()
+  m, w = s.memory()
+  memory.update(m)
+  swap.update(w)
 
   if processes:
-    command = 'ps -A --sort -rss -o comm,pmem,size,vsize'
-    p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    if err: raise IOError(err)
-    for line in out.split('\n'):
-      if line:
-        for process in processes.keys():
-          if process in str(line).lower():
-            tmp = line.split()
-            if len(tmp) > 1: processes[process]['mem'] += float(tmp[1])
-            if len(tmp) > 2: processes[process]['size'] += int(tmp[2])
-            if len(tmp) > 3: processes[process]['vsize'] += int(tmp[3])
+    for pid, comm in s.processes():
+      comm = comm.lower()
+      matches = [ process for process in processes.keys() if process in comm ]
+      if not matches: continue
+      statm = s.statm(pid)
+      if statm is None: continue
+      for process in matches:
+        # Same units as ps: %mem of the physical total, size (data + stack) and vsize in KiB
+        if memory['total']: processes[process]['mem'] += round(100.0 * statm[1] / memory['total'], 1)
+        processes[process]['size'] += statm[5] // 1024
+        processes[process]['vsize'] += statm[0] // 1024
 
   return memory, swap, processes
 
@@ -147,38 +976,100 @@ if __name__ == "__main__":
   if args['listprocesses']:
     print list_processes()
     sys.exit(0)
+  elif args['export']:
+    f = sys.stdout
+    if str(args['outputfile']).lower() == "stderr":
+      f = sys.stderr
+    elif str(args['outputfile']).lower() != "stdout":
+      f = open(args['outputfile'], 'a')
+    columns = None
+    for segment in BinaryCapture.segments(args['export']):
+      capture = BinaryCapture(segment)
+      capture.csv(f, capture.columns != columns)
+      columns = capture.columns
+      capture.close()
+    if f not in [sys.stdout, sys.stderr]: f.close()
   else:
     header = True
     # if str(args['outputfile']).lower() in ['stdout','stderr']: header = False
     if header and os.path.isfile(args['outputfile']): header = False
     memory_blank    = {'total':0, 'used':0, 'free':0, 'shared':0, 'buffers':0, 'cached':0}
     swap_blank      = {'total':0, 'used':0, 'free':0}
+    columns = ['memory total','memory used','memory free','memory shared','memory buffers','memory cached','swap total','swap used','swap free']
+    for process in sorted(set(args['processes'])):
+      columns += [process + " memory", process + " size", process + " vsize"]
     f = sys.stdout
-    if str(args['outputfile']).lower() == "stdout":
+    if args['format'] == 'binary':
+      f = BinaryWriter(args['outputfile'], columns, rotate_size = args['rotatesize'], rotate_time = args['rotatetime'],
+                       sync = args['sync'], compress = not args['nocompress'])
+    elif str(args['outputfile']).lower() == "stdout":
       f = sys.stdout
     elif str(args['outputfile']).lower() == "stderr":
       f = sys.stderr
     else:
       f = open(args['outputfile'], 'a')
 
-    for c in range(args['count']):
-      processes_blank = {}
-      for process in args['processes']:
-        processes_blank[process] = {'mem':0, 'size':0, 'vsize':0}
-      date = str(time.strftime("%Y-%m-%d %H:%M:%S"))
-      if header:
-        tmp = ['date','memory total','memory used','memory free','memory shared','memory buffers','memory cached','swap total','swap used','swap free']
+    tracker = None
+    if args['perpid'] or args['daemon']:
+      tracker = LeakTracker(get_sampler(), args['processes'], window = args['window'], rate = args['rate'], trees = args['tree'], max_pids = args['maxpids'])
+
+    daemon, servers = None, []
+    if args['daemon']:
+      daemon = MemoryDaemon(columns, tracker)
+      servers = serve(daemon, args['socket'], args['http'])
+      signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+      args['count'] = None
+
+    warned = False
+    try:
+      for tick in schedule(args['count'], args['delay']):
+        processes_blank = {}
+        for process in args['processes']:
+          processes_blank[process] = {'mem':0, 'size':0, 'vsize':0}
+        memory, swap, processes = get_data(memory_blank.copy(), swap_blank.copy(), processes_blank.copy())
+        values = [memory['total'], memory['used'], memory['free'], memory['shared'], memory['buffers'], memory['cached'], swap['total'], swap['used'], swap['free']]
         for process in sorted(processes_blank.keys()):
-          tmp += [process + " memory", process + " size", process + " vsize"]
-        f.write(",".join(tmp) + "\n")
-        header = False   
-      memory, swap, processes = get_data(memory_blank.copy(), swap_blank.copy(), processes_blank.copy())
-      tmp = [date, str(memory['total']), str(memory['used']), str(memory['free']), str(memory['shared']), str(memory['buffers']), str(memory['cached']), str(swap['total']), str(swap['used']), str(swap['free'])]
-      for process in sorted(processes_blank.keys()):
-        tmp += [str(processes[process]['mem']), str(processes[process]['size']), str(processes[process]['vsize'])]
-
-      f.write(",".join(tmp) + "\n")
-      if c < max(range(args['count'])): time.sleep(args['delay'])
-
-    if str(args['outputfile']).lower() not in ["stdout","stderr"]:
-      f.close()
+          values += [processes[process]['mem'], processes[process]['size'], processes[process]['vsize']]
+
+        if args['format'] == 'binary':
+          f.write(tick, values)
+        elif daemon and f is sys.stdout:
+          pass
+        else:
+          if header:
+            f.write(",".join(['date'] + columns) + "\n")
+            header = False
+          date = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(tick))
+          if args['delay'] != int(args['delay']): date += ".%03d" % (tick % 1 * 1000)
+          f.write(",".join([date] + [ str(x) for x in values ]) + "\n")
+        if daemon:
+          daemon.add(tick, values)
+          reports = daemon.update(tick)
+        elif tracker:
+          reports = tracker.update(tick)
+        if tracker:
+          if tracker.skipped and not warned:
+            sys.stderr.write("warning: following only %d processes, %d more match (see --maxpids)\n" % (tracker.max_pids, tracker.skipped))
+            warned = True
+          for report in reports:
+            sys.stderr.write("suspect leak: " + format_report(report) + "\n")
+    except KeyboardInterrupt:
+      pass
+    finally:
+      for server in servers:
+        server.shutdown()
+        server.server_close()
+        if hasattr(server, "inode"):
+          # Only remove the socket if it is still ours
+          try:
+            info = os.lstat(args['socket'])
+            if stat.S_ISSOCK(info.st_mode) and (info.st_dev, info.st_ino) == server.inode: os.remove(args['socket'])
+          except OSError:
+            pass
+
+      if tracker and args['perpid']:
+        for report in tracker.report():
+          if report['metric'] == 'pss': sys.stderr.write(format_report(report) + "\n")
+
+      if f not in [sys.stdout, sys.stderr]:
+        f.close()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""
+writeLDIF() / readLDIF() round trips
+"""
+import unittest, cStringIO
+
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import brandt
+
+
+class RoundTripTest(unittest.TestCase):
+
+  def roundtrip(self, entries):
+    output = cStringIO.StringIO()
+    brandt.writeLDIF(output, entries)
+    return list(brandt.readLDIF(cStringIO.StringIO(output.getvalue())))
+
+  def test_awkward_values(self):
+    values = ["line1\n", "line1\r\n", "two\nlines", "trailing space ", " leading space",
+              ":leading colon", "<leading angle", "caf\xc3\xa9", "plain", "x" * 200]
+    entries = [ ("cn=test%d,o=x" % i, {'description': [value]}) for i, value in enumerate(values) ]
+    self.assertEqual(self.roundtrip(entries), entries)
+
+  def test_awkward_dn(self):
+    entries = [ ("cn=caf\xc3\xa9,o=x", {'cn': ["caf\xc3\xa9"]}), ("cn=a\n,o=x", {'cn': ["a\n"]}) ]
+    self.assertEqual(self.roundtrip(entries), entries)
+
+  def test_trailing_newline_is_encoded(self):
+    output = cStringIO.StringIO()
+    brandt.writeLDIF(output, [("cn=a,o=x", {'description': ["line1\n"]})])
+    self.assertIn("description:: ", output.getvalue())
+
+
+if __name__ == "__main__":
+  unittest.main()
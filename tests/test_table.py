@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""
+ldapRows() / renderTable()
+"""
+import unittest, cStringIO
+
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import brandt
+
+
+class LdapRowsTest(unittest.TestCase):
+
+  def test_rows(self):
+    entries = [ ("cn=a,o=x", {'cn': ["a"], 'mail': ["a@x", "b@x"]}), ("cn=b,o=x", {'cn': ["b"]}) ]
+    self.assertEqual(list(brandt.ldapRows(entries, ["cn", "mail"])),
+                     [ ["cn=a,o=x", ["a"], ["a@x", "b@x"]], ["cn=b,o=x", ["b"], []] ])
+    self.assertEqual(list(brandt.ldapRows(entries, ["cn"], dn = False)), [ [["a"]], [["b"]] ])
+
+  def test_referrals_are_skipped(self):
+    entries = [ ("cn=a,o=x", {'cn': ["a"]}), (None, ["ldap://other/o=y??sub"]), ("cn=b,o=x", {'cn': ["b"]}) ]
+    self.assertEqual(list(brandt.ldapRows(entries, ["cn"])), [ ["cn=a,o=x", ["a"]], ["cn=b,o=x", ["b"]] ])
+
+  def test_render_with_referrals(self):
+    entries = [ ("cn=a,o=x", {'cn': ["a"]}), (None, ["ldap://other/o=y??sub"]) ]
+    output = cStringIO.StringIO()
+    self.assertEqual(brandt.renderTable(brandt.ldapRows(entries, ["cn"]), output, headers = ["dn", "cn"]), 1)
+    self.assertEqual(output.getvalue().splitlines()[-1].split(), ["cn=a,o=x", "a"])
+
+
+if __name__ == "__main__":
+  unittest.main()